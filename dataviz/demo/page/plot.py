@@ -1,93 +1,79 @@
 import plotly.express as px
 import streamlit as st
 from config import SAMPLE_DTYPE
+from timeseries import PERIODS, count_days, rollup
 
 st.set_page_config(layout="wide")
 
+# Period -> axis label
+PERIOD_LABELS = {"day": "日期", "week": "周", "month": "月份", "quarter": "季度"}
+
 # Check if data is saved
 if st.session_state.get("_sample_aggrid") is None:
     st.warning("Please Upload a excel in the Upload page first.")
     st.stop()
 
 
-df_toplot = st.session_state._sample_aggrid["data"]
+sample_aggrid = st.session_state._sample_aggrid
+df_toplot = sample_aggrid["data"]
 for column, dtype in SAMPLE_DTYPE.items():
-    if column in df_toplot.columns:
+    # Only cast the columns the grid did not give back typed
+    if column in df_toplot.columns and df_toplot[column].dtype != dtype:
         df_toplot[column] = df_toplot[column].astype(dtype)
 
 
 st.dataframe(data=df_toplot, height=600, use_container_width=True)
 
-st.markdown("## Sample info in daily scale")
-tab1, tab2 = st.tabs(["Age group", "Gender group"])
-with tab1:
-    df_age_group = (
-        df_toplot.groupby([df_toplot["collect_time"].dt.date, "age_group"])
-        .size()
-        .reset_index(name="count")
+# Count the rows once per day, age_group and gender for each time column,
+# kept until the upload page shows another grid. Every granularity rolls up
+# these counts instead of grouping the rows again. The grid response is the
+# key, its data is a new frame on every access.
+day_counts = st.session_state.get("_sample_day_counts")
+if day_counts is None or day_counts[0] is not sample_aggrid:
+    day_counts = st.session_state._sample_day_counts = (sample_aggrid, {})
+
+st.markdown("## Sample info over time")
+col1, col2 = st.columns(2)
+with col1:
+    period = st.radio("Granularity", options=PERIODS, index=2, horizontal=True)
+with col2:
+    time_column = st.radio(
+        "Time", options=["collect_time", "receive_time"], horizontal=True
     )
-
-    fig_age_group = px.line(
-        df_age_group,
-        x="collect_time",
-        y="count",
-        color="age_group",
-        title="按年龄段分组的送样量折线图",
-        labels={"collect_time": "时间", "count": "送样量", "age_group": "年龄组"},
+if time_column not in day_counts[1]:
+    day_counts[1][time_column] = count_days(
+        df_toplot, time_column, ["age_group", "gender"]
     )
-    st.plotly_chart(fig_age_group, use_container_width=True)
+df_counts = day_counts[1][time_column]
 
-with tab2:
-    df_gender = (
-        df_toplot.groupby([df_toplot["collect_time"].dt.date, "gender"])
-        .size()
-        .reset_index(name="count")
-    )
 
-    fig_gender = px.line(
-        df_gender,
-        x="collect_time",
+def plot_counts(group, title, labels):
+    fig = px.line(
+        rollup(df_counts, period, group),
+        x=period,
         y="count",
-        color="gender",
-        title="按性别分组的送样量折线图",
-        labels={"collect_time": "时间", "count": "送样量", "性别": "性别"},
+        color=group,
+        title=title,
+        labels={period: PERIOD_LABELS[period], **labels},
     )
-    st.plotly_chart(fig_gender, use_container_width=True)
+    fig.update_xaxes(categoryorder="category ascending")
+    if period == "month":
+        fig.update_layout(xaxis=dict(tickformat="%Y-%m"))
+    return fig
 
 
-df_toplot["month"] = df_toplot["collect_time"].dt.to_period("M").astype(str)
-
-st.markdown("## Sample info in monthly scale")
 tab1, tab2 = st.tabs(["Age group", "Gender group"])
 with tab1:
-    df_age_group_month = (
-        df_toplot.groupby(["month", "age_group"]).size().reset_index(name="count")
+    fig_age_group = plot_counts(
+        "age_group",
+        "按年龄段分组的送样量折线图",
+        {"count": "送样量", "age_group": "年龄组"},
     )
-
-    fig_age_group_month = px.line(
-        df_age_group_month,
-        x="month",
-        y="count",
-        color="age_group",
-        title="按年龄段分组的送样量折线图",
-        labels={"month": "月份", "count": "送样量", "age_group": "年龄组"},
-    )
-    fig_age_group_month.update_layout(xaxis=dict(tickformat="%Y-%m"))
-    st.plotly_chart(fig_age_group_month, use_container_width=True)
+    st.plotly_chart(fig_age_group, use_container_width=True)
 
 with tab2:
-    df_gender_month = (
-        df_toplot.groupby(["month", "gender"]).size().reset_index(name="count")
-    )
-
     # 使用 plotly.express 创建按性别分组的送样量折线图
-    fig_gender_month = px.line(
-        df_gender_month,
-        x="month",
-        y="count",
-        color="gender",
-        title="按性别分组的送样量折线图",
-        labels={"month": "月份", "count": "送样量", "性别": "性别"},
+    fig_gender = plot_counts(
+        "gender", "按性别分组的送样量折线图", {"count": "送样量", "性别": "性别"}
     )
-    fig_gender_month.update_layout(xaxis=dict(tickformat="%Y-%m"))
-    st.plotly_chart(fig_gender_month, use_container_width=True)
+    st.plotly_chart(fig_gender, use_container_width=True)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Periods the day counts can roll up to
+PERIODS = ["day", "week", "month", "quarter"]
+
+
+def day_index(times: pd.Series) -> pd.Series:
+    """
+    Bin datetimes into days since 1970-01-01, as nullable Int32.
+    """
+    days = times.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    return pd.Series(
+        pd.arrays.IntegerArray(days.astype(np.int32), np.isnat(days)),
+        index=times.index,
+        name=times.name,
+    )
+
+
+def _day_labels(days: np.ndarray, period: str) -> np.ndarray:
+    dates = days.astype("datetime64[D]")
+    if period == "day":
+        return np.datetime_as_string(dates, unit="D")
+    if period == "week":
+        iso = pd.DatetimeIndex(dates).isocalendar()
+        return np.array(
+            [f"{year}-W{week:02d}" for year, week in zip(iso["year"], iso["week"])]
+        )
+    months = dates.astype("datetime64[M]")
+    if period == "month":
+        return np.datetime_as_string(months, unit="M")
+    return np.array(
+        [f"{1970 + m // 12}-Q{m % 12 // 3 + 1}" for m in months.astype(np.int64)]
+    )
+
+
+def period_labels(days: pd.Series, period: str) -> pd.Series:
+    """
+    Label day indexes by period, e.g. "2024-01-31", "2024-W05", "2024-01" or
+    "2024-Q1". Labels are made once per distinct day.
+    """
+    valid = days.notna().to_numpy()
+    distinct_days, inverse = np.unique(
+        days.to_numpy(dtype=np.int64, na_value=0)[valid], return_inverse=True
+    )
+    labels = np.full(len(days), None, dtype=object)
+    labels[valid] = _day_labels(distinct_days, period)[inverse]
+    return pd.Series(labels, index=days.index, name=period)
+
+
+def count_days(df: pd.DataFrame, time_column: str, groups: list) -> pd.DataFrame:
+    """
+    Count the rows of df per day of time_column and groups, in one groupby.
+    """
+    return (
+        df.groupby(
+            [day_index(df[time_column]).rename("day")] + groups,
+            observed=True,
+            dropna=False,
+        )
+        .size()
+        .reset_index(name="count")
+    )
+
+
+def rollup(df_counts: pd.DataFrame, period: str, group: str) -> pd.DataFrame:
+    """
+    Sum the day counts of count_days per period and group, without the rows.
+    """
+    return (
+        df_counts["count"]
+        .groupby(
+            [period_labels(df_counts["day"], period), df_counts[group]], observed=True
+        )
+        .sum()
+        .reset_index(name="count")
+    )
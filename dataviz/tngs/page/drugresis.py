@@ -1,13 +1,14 @@
 import pandas as pd
 import streamlit as st
-from page.sample import _load_sample_sheet
-from st_aggrid import GridOptionsBuilder, JsCode
+from st_aggrid import JsCode
 from utils.config import AgGridConfig, GridOptionsBuilderConfig
-from utils.constants import DRUGRESIS_COLUMNS, DRUGRESIS_DTYPE, LICENSE_KEY
+from utils.constants import LICENSE_KEY
+from utils.dataset import load_sheet, merged_sheet
+from utils.schema import DRUGRESIS_MERGE_SCHEMA
 
 # Initialize session state for dataframes
 session_state_keys = [
-    "_uploaded_file",
+    "_dataset_key",
     "_drugresis_df",
     "_drugresis_aggrid",
 ]
@@ -52,31 +53,18 @@ RETAIN_FILTER_STATE_OPTIONS = {
 }
 
 
-def _load_drugresis_sheet(file, sheet_name="drugresis"):
-    df = pd.read_excel(file, sheet_name=sheet_name, dtype=DRUGRESIS_DTYPE)
-    df = df.loc[:, DRUGRESIS_COLUMNS]
-    return df
-
-
-def _merge_sample_df(df_drugresis: pd.DataFrame, df_sample: pd.DataFrame):
-    df_merge = df_sample.merge(
-        df_drugresis, left_on="sample_name", right_on="sample_name", how="left"
-    )
-    return df_merge
-
-
 @st.experimental_fragment()
 def upload_data():
     # Check if data is loaded
-    if st.session_state.get("_uploaded_file") is None:
+    if st.session_state.get("_dataset_key") is None:
         st.warning("Please Upload a excel in the Home page first.")
         st.stop()
 
-    uploaded_file = st.session_state._uploaded_file
+    dataset_key = st.session_state._dataset_key
     try:
-        df_drugresis = _load_drugresis_sheet(file=uploaded_file)
-        df_sample = _load_sample_sheet(uploaded_file)
-        df_merge = _merge_sample_df(df_drugresis=df_drugresis, df_sample=df_sample)
+        df_drugresis = load_sheet(dataset_key, "drugresis")
+        # Built once per dataset, shared with the other sessions
+        df_merge = merged_sheet(dataset_key, "drugresis")
         st.session_state._drugresis_df = df_merge
     except Exception as e:
         st.error(f"Error reading the uploaded file: {e}")
@@ -88,7 +76,6 @@ def upload_data():
 def process_data(df_drugresis: pd.DataFrame):
     if st.session_state.get("_drugresis_df") is not None:
         df_drugresis = st.session_state._drugresis_df
-        gb = GridOptionsBuilder.from_dataframe(df_drugresis)
         ag_grid_config = AgGridConfig(
             grid_options_builder_config=GridOptionsBuilderConfig(
                 configure_pagination=[{"enabled": True}],
@@ -102,7 +89,12 @@ def process_data(df_drugresis: pd.DataFrame):
                 ],
                 configure_grid_options=[RETAIN_FILTER_STATE_OPTIONS],
             ),
+            # The merged sheet is large and only browsed here, the browser
+            # gets one page of it at a time
+            row_model="paged",
+            transport="columnar",
             kwargs={
+                "key": "drugresis_grid",
                 "theme": "streamlit",
                 "height": 800,
                 "allow_unsafe_jscode": True,
@@ -113,11 +105,17 @@ def process_data(df_drugresis: pd.DataFrame):
 
         tab1, tab2 = st.tabs(["AgGrid", "Data"])
         with tab1:
-            sample_grid_table = ag_grid_config.get_aggrid(gb, df_drugresis)
+            sample_grid_table = ag_grid_config.get_aggrid(
+                None, df_drugresis, DRUGRESIS_MERGE_SCHEMA
+            )
             st.session_state._drugresis_aggrid = sample_grid_table
 
         with tab2:
-            st.write(st.session_state._drugresis_aggrid.data)
+            # Like the grid, only the page shown is sent unless asked for
+            if st.toggle("Show every filtered row", key="drugresis_data_all"):
+                st.dataframe(st.session_state._drugresis_aggrid.data)
+            else:
+                st.dataframe(st.session_state._drugresis_aggrid.page_data)
 
     else:
         st.write("Please upload a file to proceed.")
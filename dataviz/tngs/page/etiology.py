@@ -1,16 +1,27 @@
 import pandas as pd
 import streamlit as st
-from page.sample import _load_sample_sheet
-from st_aggrid import GridOptionsBuilder, JsCode
+from st_aggrid import JsCode
 from utils.config import AgGridConfig, GridOptionsBuilderConfig
-from utils.constants import ETIOLOGY_COLUMNS, ETIOLOGY_DTYPE, LICENSE_KEY
-from utils.plot import sample_etiology_heatmap
+from utils.constants import GRID_PAGE_SIZE, HEATMAP_TOP_K, LICENSE_KEY
+from utils.cube import build_cube
+from utils.dataset import load_sheet, merged_sheet, view_cube, view_ranking
+from utils.figcache import cancel_figures, draw_figures, grid_view_key, submit_figure
+from utils.grid import grid_view
+from utils.plot import (
+    plot_etiology_heatmap,
+    plot_pathogen_detail,
+    sample_etiology_matrix,
+)
+from utils.schema import ETIOLOGY_MERGE_SCHEMA
 
 # Initialize session state for dataframes
 session_state_keys = [
-    "_uploaded_file",
+    "_dataset_key",
     "_etiology_df",
     "_etiology_aggrid",
+    "_etiology_ranking",
+    "_etiology_matrix",
+    "_etiology_figure_jobs",
 ]
 for key in session_state_keys:
     if key not in st.session_state:
@@ -53,31 +64,18 @@ RETAIN_FILTER_STATE_OPTIONS = {
 }
 
 
-def _load_etiology_sheet(file, sheet_name="etiology"):
-    df = pd.read_excel(file, sheet_name=sheet_name, dtype=ETIOLOGY_DTYPE)
-    df = df.loc[:, ETIOLOGY_COLUMNS]
-    return df
-
-
-def _merge_sample_df(df_etiology: pd.DataFrame, df_sample: pd.DataFrame):
-    df_merge = df_sample.merge(
-        df_etiology, left_on="sample_name", right_on="sample_name", how="left"
-    )
-    return df_merge
-
-
 @st.experimental_fragment()
 def upload_data():
     # Check if data is loaded
-    if st.session_state.get("_uploaded_file") is None:
+    if st.session_state.get("_dataset_key") is None:
         st.warning("Please Upload a excel in the Home page first.")
         st.stop()
 
-    uploaded_file = st.session_state._uploaded_file
+    dataset_key = st.session_state._dataset_key
     try:
-        df_etiology = _load_etiology_sheet(file=uploaded_file)
-        df_sample = _load_sample_sheet(uploaded_file)
-        df_merge = _merge_sample_df(df_etiology=df_etiology, df_sample=df_sample)
+        df_etiology = load_sheet(dataset_key, "etiology")
+        # Built once per dataset, shared with the other sessions
+        df_merge = merged_sheet(dataset_key, "etiology")
         st.session_state._etiology_df = df_merge
     except Exception as e:
         st.error(f"Error reading the uploaded file: {e}")
@@ -88,7 +86,6 @@ def upload_data():
 def process_data(df_etiology: pd.DataFrame):
     if st.session_state.get("_etiology_df") is not None:
         df_etiology = st.session_state._etiology_df
-        gb = GridOptionsBuilder.from_dataframe(df_etiology)
         ag_grid_config = AgGridConfig(
             grid_options_builder_config=GridOptionsBuilderConfig(
                 configure_pagination=[{"enabled": True}],
@@ -98,6 +95,9 @@ def process_data(df_etiology: pd.DataFrame):
                 configure_first_column_as_index=[{"headerText": "sample_name"}],
                 configure_grid_options=[RETAIN_FILTER_STATE_OPTIONS],
             ),
+            # The view is rebuilt from the dataset by row position
+            return_mode="index",
+            transport="columnar",
             kwargs={
                 "theme": "streamlit",
                 "height": 800,
@@ -109,11 +109,21 @@ def process_data(df_etiology: pd.DataFrame):
 
         tab1, tab2 = st.tabs(["AgGrid", "Data"])
         with tab1:
-            sample_grid_table = ag_grid_config.get_aggrid(gb, df_etiology)
+            sample_grid_table = ag_grid_config.get_aggrid(
+                None, df_etiology, ETIOLOGY_MERGE_SCHEMA
+            )
             st.session_state._etiology_aggrid = sample_grid_table
 
         with tab2:
-            st.write(st.session_state._etiology_aggrid.data)
+            # Only the first rows of the view are sent unless asked for
+            df_data = st.session_state._etiology_aggrid.data
+            if st.toggle("Show every filtered row", key="etiology_data_all"):
+                st.dataframe(df_data)
+            else:
+                st.dataframe(df_data.head(GRID_PAGE_SIZE))
+                st.caption(
+                    f"First {min(GRID_PAGE_SIZE, len(df_data))} of {len(df_data)} rows"
+                )
 
     else:
         st.write("Please upload a file to proceed.")
@@ -122,9 +132,22 @@ def process_data(df_etiology: pd.DataFrame):
 @st.experimental_fragment()
 def etiology_plot():
     print("Running plot")
-    df_toplot = st.session_state._etiology_aggrid.data
+    # The patho ranking is built once per dataset and grid filter, the
+    # widgets below only slice it and never touch the rows
+    dataset_key = st.session_state._dataset_key
+    view_key = grid_view_key(dataset_key, "etiology", st.session_state._etiology_aggrid)
+    if (st.session_state._etiology_ranking or (None,))[0] != view_key:
+        df_toplot = grid_view(
+            st.session_state._etiology_df, st.session_state._etiology_aggrid
+        )
+        st.session_state._etiology_ranking = (
+            view_key,
+            df_toplot,
+            view_ranking(dataset_key, "etiology", "patho_name", df_toplot),
+        )
+    view_key, df_toplot, ranking = st.session_state._etiology_ranking
     # Get total unique pathos count
-    total_patho_num = df_toplot["patho_name"].nunique()
+    total_patho_num = len(ranking.codes)
 
     # Step 1: Slider to select the number of pathos to display
     selected_patho_num = st.slider(
@@ -136,12 +159,7 @@ def etiology_plot():
     st.write(selected_patho_num)
 
     # Step 2: Get the top N pathos based on selected patho count
-    top_pathos = (
-        df_toplot["patho_name"]
-        .value_counts()
-        .nlargest(selected_patho_num)
-        .index.tolist()
-    )
+    top_pathos = ranking.top(selected_patho_num).tolist()
 
     # Step 3: Multiselect widget for user to select specific pathos of interest
     selected_pathos = st.multiselect(
@@ -150,17 +168,71 @@ def etiology_plot():
         default=top_pathos,
     )
 
-    # Step 4: Filter the dataframe based on final selected pathos
-    filtered_df = df_toplot.loc[df_toplot["patho_name"].isin(selected_pathos)]
-
     if st.button("Update plot"):
+        # Step 4: Filter the dataframe based on final selected pathos
+        filtered_df = df_toplot.loc[
+            ranking.mask(df_toplot["patho_name"], selected_pathos)
+        ]
+        cube = view_cube(dataset_key, "etiology", df_toplot)
+        # Detections come from the cube, the monthly sample totals count the
+        # distinct samples with a selected patho. Both heatmaps render from
+        # the same matrix, kept until the next update.
+        sample_cube = build_cube(filtered_df, ["day"], distinct="sample_name")
+        matrix_key = f"{view_key}|{sorted(map(str, selected_pathos))}"
+        st.session_state._etiology_matrix = (
+            matrix_key,
+            sample_etiology_matrix(
+                cube=cube, sample_cube=sample_cube, pathos=selected_pathos
+            ),
+        )
+
+    matrix_key, matrix = st.session_state.get("_etiology_matrix") or (None, None)
+    if matrix is not None and len(matrix.pathos):
+        col1, col2 = st.columns(2)
+        top_k = col1.number_input(
+            "Pathos drawn as their own row (the others are summed as Other):",
+            min_value=1,
+            max_value=len(matrix.pathos),
+            value=min(HEATMAP_TOP_K, len(matrix.pathos)),
+        )
+        cluster = col2.checkbox("Order rows by similar monthly profiles")
+        # The figures are submitted at once and computed in worker threads,
+        # each placeholder is filled as its figure completes
+        cancel_figures(st.session_state._etiology_figure_jobs)
+        jobs = {
+            mode: submit_figure(
+                matrix_key,
+                plot_etiology_heatmap,
+                matrix,
+                mode,
+                top_k=top_k,
+                cluster=cluster,
+            )
+            for mode in ("count", "frequency")
+        }
         tab1, tab2 = st.tabs(["Count", "Frequency"])
-        with tab1:
-            fig_count = sample_etiology_heatmap(filtered_df)
-            st.plotly_chart(fig_count, use_container_width=True)
-        with tab2:
-            fig_freq = sample_etiology_heatmap(filtered_df, mode="frequency")
-            st.plotly_chart(fig_freq, use_container_width=True)
+        charts = {"count": tab1.empty(), "frequency": tab2.empty()}
+
+        # Detail of a single patho, e.g. one summed into the Other row
+        detail_patho = st.selectbox(
+            "Show the monthly detail of a patho:",
+            options=matrix.pathos.astype(str),
+            index=None,
+        )
+        if detail_patho is not None:
+            jobs["detail"] = submit_figure(
+                matrix_key, plot_pathogen_detail, matrix, detail_patho
+            )
+            charts["detail"] = st.empty()
+        st.session_state._etiology_figure_jobs = jobs
+
+        for chart in charts.values():
+            chart.caption("Plotting...")
+        draw_figures(
+            jobs,
+            charts,
+            {"count": "Count", "frequency": "Frequency", "detail": detail_patho},
+        )
 
 
 upload_data()
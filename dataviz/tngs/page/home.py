@@ -1,13 +1,84 @@
 import streamlit as st
+from utils.dataset import (
+    append_workbook,
+    get_workbook,
+    hold_workbook,
+    load_workbooks,
+    registry_stats,
+    workbook_key,
+)
+from utils.schema import describe_coercion_reports
 
 st.write("# Welcome to Streamlit Demo TNGS App! 👋")
 
-uploaded_file = st.file_uploader(
-    label="Please choose an Excel file to upload", type=["xlsx"]
+upload_mode = st.radio(
+    "Upload mode",
+    options=["Replace", "Append"],
+    horizontal=True,
+    help="Append merges delta workbooks (same sheets as a full upload) into "
+    "the current dataset, skipping samples and drug resistances already in it.",
+)
+
+uploaded_files = st.file_uploader(
+    label="Please choose Excel files to upload",
+    type=["xlsx"],
+    accept_multiple_files=True,
+    help="Workbooks uploaded together (e.g. one per hospital) are analysed "
+    "as one dataset, with a source_file column.",
 )
 
-if uploaded_file is not None:
-    st.session_state._uploaded_file = uploaded_file
+# The uploader keeps its files across reruns, only ingest an upload once
+uploaded_file_ids = tuple(file.file_id for file in uploaded_files)
+if uploaded_files and uploaded_file_ids != st.session_state.get("_ingested_file_ids"):
+    try:
+        if upload_mode == "Append" and st.session_state.get("_dataset_key"):
+            dataset_key = append_workbook(st.session_state._dataset_key, uploaded_files)
+        else:
+            dataset_key = load_workbooks(uploaded_files)
+    except Exception as e:
+        st.error(f"Error reading the uploaded file: {e}")
+    else:
+        st.session_state._uploaded_file = uploaded_files[0]
+        st.session_state._dataset_key = dataset_key
+        st.session_state._ingested_file_ids = uploaded_file_ids
+
+# Cells that did not parse are kept as missing values, list them per file
+for uploaded_file in uploaded_files:
+    try:
+        coercion_reports = get_workbook(workbook_key(uploaded_file)).coercion_reports
+    except KeyError:
+        continue
+    if coercion_reports:
+        st.warning(
+            f"Some cells of {uploaded_file.name} could not be parsed and are "
+            "left empty:\n"
+            + "\n".join(
+                f"- {line}" for line in describe_coercion_reports(coercion_reports)
+            )
+        )
+
+if st.session_state.get("_dataset_key") is not None:
+    try:
+        workbook = hold_workbook(st.session_state._dataset_key)
+    except KeyError as e:
+        st.warning(e.args[0])
+    else:
+        st.markdown("### Current dataset")
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Samples", len(workbook.sample))
+        col2.metric("Etiology rows", len(workbook.etiology))
+        col3.metric("Drugresis rows", len(workbook.drugresis))
+        stats = registry_stats()
+        st.caption(
+            f"{stats['datasets']} datasets ({stats['bytes'] / 2**20:.1f} MB) "
+            f"shared in memory by {stats['handles']} sessions"
+        )
+        tab1, tab2 = st.tabs(["Monthly samples", "Pathogen ranking"])
+        with tab1:
+            monthly_samples = workbook.aggregates.monthly_samples
+            st.bar_chart(monthly_samples.set_axis(monthly_samples.index.astype(str)))
+        with tab2:
+            st.dataframe(workbook.aggregates.pathogen_ranking, use_container_width=True)
 
 
 st.markdown(
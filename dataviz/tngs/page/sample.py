@@ -1,16 +1,28 @@
 import pandas as pd
-import plotly.express as px
 import streamlit as st
-from st_aggrid import GridOptionsBuilder, JsCode
+from st_aggrid import JsCode
 from utils.config import AgGridConfig, GridOptionsBuilderConfig
-from utils.constants import LICENSE_KEY, SAMPLE_COLUMNS, SAMPLE_DTYPE
-from utils.plot import plot_histogram, plot_pie_chart, plot_wordcloud
+from utils.constants import GRID_PAGE_SIZE, LICENSE_KEY, SAMPLE_COLUMNS
+from utils.cube import CUBE_PERIODS
+from utils.dataset import load_sheet, view_cube, view_token_frequencies
+from utils.figcache import cancel_figures, draw_figures, grid_view_key, submit_figure
+from utils.grid import grid_view
+from utils.plot import (
+    plot_histogram,
+    plot_period_counts,
+    plot_pie_chart,
+    plot_wordcloud_frequencies,
+)
+from utils.schema import SAMPLE_SCHEMA, apply_schema
 
 # Initialize session state for dataframes
 session_state_keys = [
-    "_uploaded_file",
+    "_dataset_key",
     "_sample_df",
     "_sample_aggrid",
+    "_sample_plot_view",
+    "_sample_plot_cubes",
+    "_sample_figure_jobs",
 ]
 for key in session_state_keys:
     if key not in st.session_state:
@@ -53,22 +65,16 @@ RETAIN_FILTER_STATE_OPTIONS = {
 }
 
 
-def _load_sample_sheet(file, sheet_name="sample"):
-    df = pd.read_excel(file, sheet_name=sheet_name, dtype=SAMPLE_DTYPE)
-    df = df.loc[:, SAMPLE_COLUMNS]
-    return df
-
-
 @st.experimental_fragment()
 def load_data():
     # Check if data is loaded
-    if st.session_state.get("_uploaded_file") is None:
+    if st.session_state.get("_dataset_key") is None:
         st.warning("Please Upload a excel in the Home page first.")
         st.stop()
 
-    uploaded_file = st.session_state._uploaded_file
+    dataset_key = st.session_state._dataset_key
     try:
-        df_sample = _load_sample_sheet(file=uploaded_file)
+        df_sample = load_sheet(dataset_key, "sample", columns=SAMPLE_COLUMNS)
         st.session_state._sample_df = df_sample
     except Exception as e:
         st.error(f"Error reading the uploaded file: {e}")
@@ -79,7 +85,6 @@ def load_data():
 def process_data(df_sample: pd.DataFrame):
     if st.session_state.get("_sample_df") is not None:
         df_sample = st.session_state._sample_df
-        gb = GridOptionsBuilder.from_dataframe(df_sample)
         ag_grid_config = AgGridConfig(
             grid_options_builder_config=GridOptionsBuilderConfig(
                 configure_pagination=[{"enabled": True}],
@@ -101,6 +106,9 @@ def process_data(df_sample: pd.DataFrame):
                 ],
                 configure_grid_options=[RETAIN_FILTER_STATE_OPTIONS],
             ),
+            # The view is rebuilt from the dataset by row position
+            return_mode="index",
+            transport="columnar",
             kwargs={
                 "theme": "streamlit",
                 "height": 800,
@@ -112,16 +120,63 @@ def process_data(df_sample: pd.DataFrame):
 
         tab1, tab2 = st.tabs(["AgGrid", "Data"])
         with tab1:
-            sample_grid_table = ag_grid_config.get_aggrid(gb, df_sample)
+            sample_grid_table = ag_grid_config.get_aggrid(
+                None, df_sample, SAMPLE_SCHEMA
+            )
             st.session_state._sample_aggrid = sample_grid_table
 
         with tab2:
-            st.write(st.session_state._sample_aggrid.data)
+            # Only the first rows of the view are sent unless asked for
+            df_data = st.session_state._sample_aggrid.data
+            if st.toggle("Show every filtered row", key="sample_data_all"):
+                st.dataframe(df_data)
+            else:
+                st.dataframe(df_data.head(GRID_PAGE_SIZE))
+                st.caption(
+                    f"First {min(GRID_PAGE_SIZE, len(df_data))} of {len(df_data)} rows"
+                )
 
     else:
         st.write("Please upload a file to proceed.")
 
-    print("Processed data:", st.session_state._sample_aggrid.data.shape)
+    print(
+        "Processed data:",
+        grid_view(st.session_state._sample_df, st.session_state._sample_aggrid).shape,
+    )
+
+
+# Overview tab -> (chart function, column)
+OVERVIEW_TABS = {
+    "Sample type": (plot_pie_chart, "sample_type"),
+    "Gender": (plot_pie_chart, "gender"),
+    "Age": (plot_pie_chart, "age_group"),
+    "Department": (plot_pie_chart, "department"),
+    "Patho": (plot_histogram, "number_of_detected_pathos"),
+    "Drugresis": (plot_histogram, "number_of_detected_drugresis"),
+    "出具结果": (plot_wordcloud_frequencies, "出具结果"),
+    "clinical_diagnosis": (plot_wordcloud_frequencies, "clinical_diagnosis"),
+}
+
+# Time tab -> (group column, title, labels)
+TIME_TABS = {
+    "Age group": (
+        "age_group",
+        "按年龄段分组的送样量折线图",
+        {"count": "送样量", "age_group": "年龄组"},
+    ),
+    # 按性别分组的送样量折线图
+    "Gender group": (
+        "gender",
+        "按性别分组的送样量折线图",
+        {"count": "送样量", "性别": "性别"},
+    ),
+}
+
+# Period -> axis label
+PERIOD_LABELS = {"day": "日期", "week": "周", "month": "月份", "quarter": "季度"}
+
+# Time column -> option label
+TIME_COLUMNS = {"collect_time": "Collect time", "receive_time": "Receive time"}
 
 
 @st.experimental_fragment()
@@ -130,88 +185,91 @@ def sample_plot():
     Make plot based on the filtered sample df
     """
     if st.button("Update plot"):
-        df_toplot = st.session_state._sample_aggrid.data
+        df_toplot = grid_view(
+            st.session_state._sample_df, st.session_state._sample_aggrid
+        )
         print("Plot data:", df_toplot.shape)
 
-        for column, dtype in SAMPLE_DTYPE.items():
-            if column in df_toplot.columns:
-                df_toplot[column] = df_toplot[column].astype(dtype)
-
-        st.markdown("## Sample overview")
-        tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs(
-            [
-                "Sample type",
-                "Gender",
-                "Age",
-                "Department",
-                "Patho",
-                "Drugresis",
-                "出具结果",
-                "clinical_diagnosis",
-            ]
+        # Only the columns the grid did not give back typed are coerced
+        df_toplot = apply_schema(df_toplot, SAMPLE_SCHEMA)
+        # Figures are cached per dataset and grid filter, an unchanged view
+        # is not plotted again
+        view_key = grid_view_key(
+            st.session_state._dataset_key, "sample", st.session_state._sample_aggrid
         )
-        with tab1:
-            fig_sampletype = plot_pie_chart(df_toplot, "sample_type")
-            st.plotly_chart(fig_sampletype, use_container_width=True)
-        with tab2:
-            fig_gender = plot_pie_chart(df_toplot, "gender")
-            st.plotly_chart(fig_gender, use_container_width=True)
-        with tab3:
-            fig_agegroup = plot_pie_chart(df_toplot, "age_group")
-            st.plotly_chart(fig_agegroup, use_container_width=True)
-        with tab4:
-            fig_department = plot_pie_chart(df_toplot, "department")
-            st.plotly_chart(fig_department, use_container_width=True)
-        with tab5:
-            fig_patho = plot_histogram(df_toplot, "number_of_detected_pathos")
-            st.plotly_chart(fig_patho, use_container_width=True)
-        with tab6:
-            fig_drugresis = plot_histogram(df_toplot, "number_of_detected_drugresis")
-            st.plotly_chart(fig_drugresis, use_container_width=True)
-        with tab7:
-            fig_result = plot_wordcloud(df_toplot, "出具结果")
-            st.pyplot(fig_result, use_container_width=True)
-        with tab8:
-            fig_clinicaldiagnosis = plot_wordcloud(df_toplot, "clinical_diagnosis")
-            st.pyplot(fig_clinicaldiagnosis, use_container_width=True)
-
-        st.markdown("## Sample info in month scale")
-        df_toplot["month"] = df_toplot["collect_time"].dt.to_period("M").astype(str)
-        tab1, tab2 = st.tabs(["Age group", "Gender group"])
-        with tab1:
-            df_age_group_month = (
-                df_toplot.groupby(["month", "age_group"])
-                .size()
-                .reset_index(name="count")
-            )
+        st.session_state._sample_plot_view = (view_key, df_toplot)
+        st.session_state._sample_plot_cubes = {}
 
-            fig_age_group_month = px.line(
-                df_age_group_month,
-                x="month",
-                y="count",
-                color="age_group",
-                title="按年龄段分组的送样量折线图",
-                labels={"month": "月份", "count": "送样量", "age_group": "年龄组"},
-            )
-            fig_age_group_month.update_layout(xaxis=dict(tickformat="%Y-%m"))
-            st.plotly_chart(fig_age_group_month, use_container_width=True)
+    if st.session_state.get("_sample_plot_view") is None:
+        return
+    # The plotted view stays until the next update, switching tabs only
+    # computes the chart of the opened tab
+    view_key, df_toplot = st.session_state._sample_plot_view
+    dataset_key = st.session_state._dataset_key
 
-        with tab2:
-            df_gender_month = (
-                df_toplot.groupby(["month", "gender"]).size().reset_index(name="count")
-            )
+    st.markdown("## Sample overview")
+    overview_tab = st.radio(
+        "Sample overview",
+        options=list(OVERVIEW_TABS),
+        horizontal=True,
+        label_visibility="collapsed",
+    )
+    plot_func, column = OVERVIEW_TABS[overview_tab]
+    # Every chart is submitted at once and computed in worker threads, each
+    # placeholder is filled as its chart completes
+    cancel_figures(st.session_state._sample_figure_jobs)
+    jobs = {}
+    charts = {"overview": st.empty()}
+    if plot_func is plot_wordcloud_frequencies:
+        jobs["overview"] = submit_figure(
+            f"{view_key}|{column}",
+            plot_wordcloud_frequencies,
+            view_token_frequencies(dataset_key, column, df_toplot),
+        )
+    else:
+        jobs["overview"] = submit_figure(view_key, plot_func, df_toplot, column)
 
-            # 使用 plotly.express 创建按性别分组的送样量折线图
-            fig_gender_month = px.line(
-                df_gender_month,
-                x="month",
-                y="count",
-                color="gender",
-                title="按性别分组的送样量折线图",
-                labels={"month": "月份", "count": "送样量", "性别": "性别"},
-            )
-            fig_gender_month.update_layout(xaxis=dict(tickformat="%Y-%m"))
-            st.plotly_chart(fig_gender_month, use_container_width=True)
+    st.markdown("## Sample info over time")
+    time_tab = st.radio(
+        "Sample info over time",
+        options=list(TIME_TABS),
+        horizontal=True,
+        label_visibility="collapsed",
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        period = st.radio("Granularity", options=CUBE_PERIODS, index=2, horizontal=True)
+    with col2:
+        time_column = st.radio(
+            "Time",
+            options=list(TIME_COLUMNS),
+            format_func=TIME_COLUMNS.get,
+            horizontal=True,
+        )
+    group, title, labels = TIME_TABS[time_tab]
+
+    # The rows are binned into days once per time column (not at all when
+    # the grid is not filtered), every granularity rolls up the same cube.
+    # The cube is built here, the worker threads cannot use the session.
+    cubes = st.session_state._sample_plot_cubes
+    if time_column not in cubes:
+        cubes[time_column] = view_cube(dataset_key, "sample", df_toplot, time_column)
+
+    charts["time"] = st.empty()
+    jobs["time"] = submit_figure(
+        f"{view_key}|{time_column}",
+        plot_period_counts,
+        cubes[time_column],
+        period,
+        group,
+        title=title,
+        labels={**labels, period: PERIOD_LABELS[period]},
+    )
+    st.session_state._sample_figure_jobs = jobs
+
+    for chart in charts.values():
+        chart.caption("Plotting...")
+    draw_figures(jobs, charts, {"overview": overview_tab, "time": time_tab})
 
 
 # Main commands to run
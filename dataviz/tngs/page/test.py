@@ -1,14 +1,17 @@
 import pandas as pd
 import streamlit as st
-from page.sample import _load_sample_sheet
-from st_aggrid import GridOptionsBuilder, JsCode
+from st_aggrid import JsCode
 from utils.config import AgGridConfig, GridOptionsBuilderConfig
-from utils.constants import ETIOLOGY_COLUMNS, ETIOLOGY_DTYPE, LICENSE_KEY
+from utils.constants import LICENSE_KEY
+from utils.cube import build_cube
+from utils.dataset import load_sheet, merged_sheet, view_cube, view_ranking
+from utils.grid import grid_view
 from utils.plot import sample_etiology_heatmap
+from utils.schema import ETIOLOGY_MERGE_SCHEMA
 
 # Initialize session state for dataframes
 session_state_keys = [
-    "_uploaded_file",
+    "_dataset_key",
     "_etiology_df",
     "_etiology_aggrid",
 ]
@@ -53,31 +56,18 @@ RETAIN_FILTER_STATE_OPTIONS = {
 }
 
 
-def _load_etiology_sheet(file, sheet_name="etiology"):
-    df = pd.read_excel(file, sheet_name=sheet_name, dtype=ETIOLOGY_DTYPE)
-    df = df.loc[:, ETIOLOGY_COLUMNS]
-    return df
-
-
-def _merge_sample_df(df_etiology: pd.DataFrame, df_sample: pd.DataFrame):
-    df_merge = df_sample.merge(
-        df_etiology, left_on="sample_name", right_on="sample_name", how="left"
-    )
-    return df_merge
-
-
 @st.experimental_fragment()
 def upload_data():
     # Check if data is loaded
-    if st.session_state.get("_uploaded_file") is None:
+    if st.session_state.get("_dataset_key") is None:
         st.warning("Please Upload a excel in the Home page first.")
         st.stop()
 
-    uploaded_file = st.session_state._uploaded_file
+    dataset_key = st.session_state._dataset_key
     try:
-        df_etiology = _load_etiology_sheet(file=uploaded_file)
-        df_sample = _load_sample_sheet(uploaded_file)
-        df_merge = _merge_sample_df(df_etiology=df_etiology, df_sample=df_sample)
+        df_etiology = load_sheet(dataset_key, "etiology")
+        # Built once per dataset, shared with the other sessions
+        df_merge = merged_sheet(dataset_key, "etiology")
         st.session_state._etiology_df = df_merge
     except Exception as e:
         st.error(f"Error reading the uploaded file: {e}")
@@ -88,7 +78,6 @@ def upload_data():
 def process_data(df_etiology: pd.DataFrame):
     if st.session_state.get("_etiology_df") is not None:
         df_etiology = st.session_state._etiology_df
-        gb = GridOptionsBuilder.from_dataframe(df_etiology)
         ag_grid_config = AgGridConfig(
             grid_options_builder_config=GridOptionsBuilderConfig(
                 configure_pagination=[{"enabled": True}],
@@ -109,7 +98,9 @@ def process_data(df_etiology: pd.DataFrame):
 
         tab1, tab2 = st.tabs(["AgGrid", "Data"])
         with tab1:
-            sample_grid_table = ag_grid_config.get_aggrid(gb, df_etiology)
+            sample_grid_table = ag_grid_config.get_aggrid(
+                None, df_etiology, ETIOLOGY_MERGE_SCHEMA
+            )
             st.session_state._etiology_aggrid = sample_grid_table
 
         with tab2:
@@ -122,9 +113,14 @@ def process_data(df_etiology: pd.DataFrame):
 @st.experimental_fragment()
 def etiology_plot():
     print("Running plot")
-    df_toplot = st.session_state._etiology_aggrid.data
+    df_toplot = grid_view(
+        st.session_state._etiology_df, st.session_state._etiology_aggrid
+    )
+    ranking = view_ranking(
+        st.session_state._dataset_key, "etiology", "patho_name", df_toplot
+    )
     # Get total unique pathos count
-    total_patho_num = df_toplot["patho_name"].nunique()
+    total_patho_num = len(ranking.codes)
 
     # Step 1: Slider to select the number of pathos to display
     selected_patho_num = st.slider(
@@ -136,12 +132,7 @@ def etiology_plot():
     st.write(selected_patho_num)
 
     # Step 2: Get the top N pathos based on selected patho count
-    top_pathos = (
-        df_toplot["patho_name"]
-        .value_counts()
-        .nlargest(selected_patho_num)
-        .index.tolist()
-    )
+    top_pathos = ranking.top(selected_patho_num).tolist()
 
     # Step 3: Multiselect widget for user to select specific pathos of interest
     selected_pathos = st.multiselect(
@@ -150,11 +141,16 @@ def etiology_plot():
         default=top_pathos,
     )
 
-    # Step 4: Filter the dataframe based on final selected pathos
-    filtered_df = df_toplot.loc[df_toplot["patho_name"].isin(selected_pathos)]
-
     if st.button("Update plot"):
-        fig = sample_etiology_heatmap(filtered_df)
+        # Step 4: Filter the dataframe based on final selected pathos
+        filtered_df = df_toplot.loc[
+            ranking.mask(df_toplot["patho_name"], selected_pathos)
+        ]
+        cube = view_cube(st.session_state._dataset_key, "etiology", df_toplot)
+        sample_cube = build_cube(filtered_df, ["day"], distinct="sample_name")
+        fig = sample_etiology_heatmap(
+            cube=cube, sample_cube=sample_cube, pathos=selected_pathos
+        )
         st.plotly_chart(fig, use_container_width=True)
 
 
@@ -0,0 +1,91 @@
+from typing import Dict, NamedTuple
+
+import pandas as pd
+
+
+class DatasetAggregates(NamedTuple):
+    # Number of samples per collect_time month
+    monthly_samples: pd.Series
+    # Number of detections per pathogen, most detected first
+    pathogen_ranking: pd.Series
+
+
+def _rank(counts: pd.Series) -> pd.Series:
+    # Most counted first, ties by label so a ranking does not depend on the
+    # order rows were added in
+    return counts.sort_index().sort_values(ascending=False, kind="stable")
+
+
+def compute_aggregates(
+    df_sample: pd.DataFrame, df_etiology: pd.DataFrame
+) -> DatasetAggregates:
+    """
+    Compute the dataset-wide aggregates from the sample and etiology sheets.
+    """
+    monthly_samples = (
+        df_sample["collect_time"].dt.to_period("M").value_counts().sort_index()
+    )
+    monthly_samples.name = "count"
+    pathogen_counts = df_etiology["patho_name"].value_counts(sort=False)
+    pathogen_counts = pathogen_counts[pathogen_counts > 0]
+    # Plain labels, categories differ between appended workbooks
+    pathogen_counts.index = pathogen_counts.index.astype(object)
+    pathogen_counts.name = "count"
+    return DatasetAggregates(monthly_samples, _rank(pathogen_counts))
+
+
+def update_aggregates(
+    aggregates: DatasetAggregates,
+    df_new_sample: pd.DataFrame,
+    df_new_etiology: pd.DataFrame,
+) -> DatasetAggregates:
+    """
+    Add the rows appended to a dataset to its aggregates, without rescanning
+    the rows already counted.
+    Input:
+        1. aggregates: aggregates of the dataset before the append
+        2. df_new_sample, df_new_etiology: rows the append added (deduped)
+    Return:
+        1. DatasetAggregates of the appended dataset
+    """
+    delta = compute_aggregates(df_new_sample, df_new_etiology)
+    monthly_samples, pathogen_counts = (
+        base_counts.add(delta_counts, fill_value=0).astype("int64")
+        for base_counts, delta_counts in zip(aggregates, delta)
+    )
+    return DatasetAggregates(monthly_samples.sort_index(), _rank(pathogen_counts))
+
+
+def aggregates_to_dict(aggregates: DatasetAggregates) -> Dict[str, Dict]:
+    """
+    Convert aggregates to plain lists, to be stored as JSON with a dataset.
+    """
+    return {
+        name: {
+            "index": counts.index.name,
+            "labels": counts.index.astype(str).tolist(),
+            "counts": counts.astype("int64").tolist(),
+        }
+        for name, counts in aggregates._asdict().items()
+    }
+
+
+def aggregates_from_dict(aggregates: Dict[str, Dict]) -> DatasetAggregates:
+    """
+    Get the aggregates stored by aggregates_to_dict.
+    """
+    monthly, ranking = aggregates["monthly_samples"], aggregates["pathogen_ranking"]
+    return DatasetAggregates(
+        pd.Series(
+            monthly["counts"],
+            index=pd.PeriodIndex(monthly["labels"], freq="M", name=monthly["index"]),
+            dtype="int64",
+            name="count",
+        ),
+        pd.Series(
+            ranking["counts"],
+            index=pd.Index(ranking["labels"], dtype=object, name=ranking["index"]),
+            dtype="int64",
+            name="count",
+        ),
+    )
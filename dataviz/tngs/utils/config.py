@@ -1,9 +1,25 @@
-from typing import Dict
+import hashlib
+import json
+import logging
+import threading
+from typing import Dict, Optional
 
 import pandas as pd
+import streamlit as st
 from pydantic import BaseModel
-from st_aggrid import AgGrid, GridOptionsBuilder, List
-from utils.constants import RETAIN_FILTER_STATE_OPTIONS
+from st_aggrid import AgGrid, GridOptionsBuilder, JsCode, List
+from st_aggrid.shared import walk_gridOptions
+from utils.constants import GRID_PAGE_SIZE, RETAIN_FILTER_STATE_OPTIONS
+from utils.grid import (
+    GridView,
+    IndexedGridReturn,
+    PagedGridReturn,
+    grid_filter_model,
+    grid_sort_model,
+    row_data,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class GridOptionsBuilderConfig(BaseModel):
@@ -38,14 +54,177 @@ class GridOptionsBuilderConfig(BaseModel):
             grid_options_builder.configure_grid_options(**_)
 
 
+# Compiled gridOptions per schema fingerprint and config, for all sessions
+_grid_options_cache: Dict[str, Dict] = {}
+_grid_options_lock = threading.Lock()
+
+
+def _js_code(value):
+    return value.js_code if isinstance(value, JsCode) else value
+
+
 class AgGridConfig(BaseModel):
     grid_options_builder_config: GridOptionsBuilderConfig
     kwargs: Dict = {}
-
-    def get_aggrid(self, grid_options_builder: GridOptionsBuilder, df: pd.DataFrame):
-        self.grid_options_builder_config.build(grid_options_builder)
-        go = grid_options_builder.build()
-        return AgGrid(df, gridOptions=go, **self.kwargs)
+    # "client": the whole frame is loaded into the grid. "paged": the frame
+    # stays in Python and the grid only gets the rows of the page shown,
+    # filtered and sorted on the Python side. A paged grid needs a key in
+    # kwargs.
+    row_model: str = "client"
+    page_size: int = GRID_PAGE_SIZE
+    # "data": data is decoded from the rows the grid sends back. "index":
+    # only the ids of the rows after filter and sort are read, data is
+    # rebuilt by position from the frame given to the grid.
+    return_mode: str = "data"
+    # "json": st_aggrid converts the frame to rows on every run. "columnar":
+    # the columns are encoded once per frame (categoricals as a dictionary
+    # and codes) and the rows are assembled from them. Needs return_mode
+    # "index" or row_model "paged", the dtypes st_aggrid records for "data"
+    # are not sent.
+    transport: str = "json"
+
+    def grid_options(
+        self, df: pd.DataFrame, schema: Optional[Dict[str, str]] = None
+    ) -> Dict:
+        """
+        Compile the gridOptions of a frame once per schema and config.
+        Input:
+            1. df: frame given to the grid, only its columns and dtypes are read
+            2. schema: declared dtypes of the columns (e.g. SAMPLE_SCHEMA),
+               they take precedence over the dtypes of df
+        Return:
+            1. gridOptions dict, shared by every rerun and session with the
+               same columns, dtypes and config. Copy it before modifying it.
+        """
+        schema = schema or {}
+        columns = [
+            (column, str(schema.get(column, dtype)))
+            for column, dtype in df.dtypes.items()
+        ]
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    columns,
+                    self.grid_options_builder_config.model_dump(),
+                    self.kwargs.get("allow_unsafe_jscode", False),
+                ],
+                sort_keys=True,
+                default=lambda value: str(_js_code(value)),
+            ).encode()
+        ).hexdigest()
+        with _grid_options_lock:
+            go = _grid_options_cache.get(key)
+        if go is not None:
+            return go
+
+        # Column types are inferred from an empty frame of the declared dtypes
+        empty = pd.DataFrame(
+            {column: pd.Series(dtype=dtype) for column, dtype in columns}
+        )
+        gb = GridOptionsBuilder.from_dataframe(empty)
+        self.grid_options_builder_config.build(gb)
+        go = gb.build()
+        if self.kwargs.get("allow_unsafe_jscode"):
+            # Done once here rather than by AgGrid on every call
+            walk_gridOptions(go, _js_code)
+        with _grid_options_lock:
+            return _grid_options_cache.setdefault(key, go)
+
+    def get_aggrid(
+        self,
+        grid_options_builder: Optional[GridOptionsBuilder],
+        df: pd.DataFrame,
+        schema: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Show df in an AgGrid.
+        Input:
+            1. grid_options_builder: builder configured with this config, None
+               to use the compiled grid_options(df, schema)
+            2. df: frame to show
+            3. schema: see grid_options
+        """
+        if grid_options_builder is None:
+            # AgGrid adds the rows to the gridOptions it is given
+            go = dict(self.grid_options(df, schema))
+        else:
+            self.grid_options_builder_config.build(grid_options_builder)
+            go = grid_options_builder.build()
+        if self.transport not in ("json", "columnar"):
+            raise ValueError(f"Invalid transport: {self.transport}")
+        if self.row_model == "paged":
+            return self._get_paged_aggrid(go, df)
+        if self.row_model != "client":
+            raise ValueError(f"Invalid row_model: {self.row_model}")
+        if self.transport == "columnar":
+            if self.return_mode != "index":
+                raise ValueError(
+                    "The columnar transport needs return_mode 'index' or "
+                    "row_model 'paged'."
+                )
+            go = self._with_row_data(go, df, cache=True)
+        response = AgGrid(df, gridOptions=go, **self.kwargs)
+        if self.return_mode == "index":
+            return IndexedGridReturn(response, df)
+        if self.return_mode != "data":
+            raise ValueError(f"Invalid return_mode: {self.return_mode}")
+        return response
+
+    def _get_paged_aggrid(self, go: Dict, df: pd.DataFrame) -> PagedGridReturn:
+        key = self.kwargs.get("key")
+        if key is None:
+            raise ValueError("A paged grid needs a key in kwargs.")
+
+        # The grid reports its filter and sort in the component value of the
+        # last run, the view is kept until the frame or the models change
+        previous = st.session_state.get(key)
+        grid_state = previous.get("gridState") if isinstance(previous, dict) else None
+        sort_model = grid_sort_model(grid_state)
+        filter_model = grid_filter_model(grid_state)
+        view = st.session_state.get(f"_{key}_view")
+        if (
+            view is None
+            or view.df is not df
+            or view.sort_model != sort_model
+            or view.filter_model != filter_model
+        ):
+            try:
+                view = GridView(df, sort_model, filter_model)
+            except ValueError as e:
+                st.warning(f"The grid filter is not applied: {e}")
+                view = GridView(df, sort_model)
+            st.session_state[f"_{key}_view"] = view
+
+        n_pages = max(1, -(-len(view) // self.page_size))
+        page_key = f"{key}_page"
+        if st.session_state.get(page_key, 1) > n_pages:
+            st.session_state[page_key] = n_pages
+        page = st.number_input("Page", min_value=1, max_value=n_pages, key=page_key)
+        st.caption(f"{len(view)} rows, {n_pages} pages")
+
+        # The grid shows a single page of rows that already pass its filters
+        go = {
+            **go,
+            "pagination": False,
+            "initialState": {
+                "sort": {"sortModel": sort_model},
+                "filter": {"filterModel": view.filter_model},
+            },
+        }
+        df_page = view.page(page - 1, self.page_size)
+        if self.transport == "columnar":
+            # Pages are new frames on every run, their columns are not kept
+            go = self._with_row_data(go, df_page, cache=False)
+        response = AgGrid(df_page, gridOptions=go, **self.kwargs)
+        return PagedGridReturn(response, view, df_page)
+
+    @staticmethod
+    def _with_row_data(go: Dict, df: pd.DataFrame, cache: bool) -> Dict:
+        rows = row_data(df, cache=cache)
+        if rows is None:
+            logger.info("Grid rows encoded by st_aggrid: a column is not encodable")
+            return go
+        return {**go, "rowData": rows}
 
 
 def test():
@@ -1,3 +1,5 @@
+import os
+
 from st_aggrid import JsCode
 
 onFilterChanged = JsCode(
@@ -35,6 +37,53 @@ RETAIN_FILTER_STATE_OPTIONS = {
     "onFilterChanged": onFilterChanged,
 }
 
+# Pathos drawn as their own heatmap row, the less detected ones are summed
+# into one "Other" row so the figure size stays bounded
+HEATMAP_TOP_K = 60
+# Decimals kept in the heatmap frequencies sent to the browser
+HEATMAP_DECIMALS = 4
+
+# Integer columns spanning up to this many values get one histogram bin per
+# value
+HISTOGRAM_MAX_INTEGER_BINS = 100
+
+# Chinese runs longer than this are split into character bigrams for the
+# word clouds, shorter runs are kept as words
+TEXT_MAX_WORD_CHARS = 6
+# Threads computing the figures of a page concurrently, off the script thread
+FIGURE_WORKERS = min(4, os.cpu_count() or 1)
+
+# Memory budget (MB) of the figures cached across reruns and sessions, as
+# serialised figures
+FIGURE_CACHE_MAX_MB = 256
+
+# Rows sent to a paged grid at a time, the rest of the frame stays in Python
+GRID_PAGE_SIZE = 100
+# Grid filter masks kept across reruns and sessions, per frame and filter
+# model
+GRID_FILTER_CACHE_ENTRIES = 64
+# Frames whose grid columns are kept encoded across reruns and sessions
+GRID_ROW_DATA_CACHE_ENTRIES = 8
+
+# Memory budget (MB) of the parsed datasets shared by all sessions. Datasets
+# no session holds are evicted least recently used first beyond it, None for
+# no limit
+DATASET_CACHE_MAX_MB = 2048
+
+# Workbook ingestion: stream rows into typed chunks instead of pd.read_excel
+INGEST_STREAMING = True
+INGEST_CHUNK_SIZE = 50_000
+# Peak memory ceiling (MB) of the typed buffers of one sheet, None for no limit
+INGEST_MAX_MEMORY_MB = None
+# Processes parsing workbooks uploaded together, None for one per CPU
+INGEST_MAX_PROCESSES = None
+
+# Local directory of the per-sheet Parquet copies of uploaded workbooks
+DATASET_STORE_DIR = os.environ.get(
+    "TNGS_DATASET_STORE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "dataviz", "tngs"),
+)
+
 LICENSE_KEY = "[TRIAL]_this_{AG_Grid}_Enterprise_key_{AG-062754}_is_granted_for_evaluation_only___Use_in_production_is_not_permitted___Please_report_misuse_to_legal@ag-grid.com___For_help_with_purchasing_a_production_key_please_contact_info@ag-grid.com___You_are_granted_a_{Single_Application}_Developer_License_for_one_application_only___All_Front-End_JavaScript_developers_working_on_the_application_would_need_to_be_licensed___This_key_will_deactivate_on_{14 August 2024}____[v3]_[01]_MTcyMzU5MDAwMDAwMA==a5f0bef6477e9746662f8e0f46e475b7"
 
 SAMPLE_DTYPE = {
@@ -139,3 +188,37 @@ DRUGRESIS_COLUMNS = [
     "en_short",
     "resis_ifreport",
 ]
+
+# Low-cardinality text columns, kept as categorical codes in memory
+CATEGORY_COLUMNS = [
+    "sample_type",
+    "gender",
+    "hospital",
+    "department",
+    "age_group",
+    "patho_name",
+    "filter_flag",
+    "patho_semiquant",
+    "patho_clincialevel",
+    "resis_DrugName",
+    "resis_gene",
+    "en_short",
+    "resis_ifreport",
+]
+
+# Formats tried in order for collect_time-like cells stored as text, date
+# cells already come out of openpyxl as datetimes
+DATETIME_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d",
+    "ISO8601",
+]
+
+# Sheets of the uploaded workbook: sheet name -> (dtype, columns)
+WORKBOOK_SHEETS = {
+    "sample": (SAMPLE_DTYPE, SAMPLE_COLUMNS),
+    "etiology": (ETIOLOGY_DTYPE, ETIOLOGY_COLUMNS),
+    "drugresis": (DRUGRESIS_DTYPE, DRUGRESIS_COLUMNS),
+}
@@ -0,0 +1,284 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from utils.schema import concat_frames
+
+# Dimensions a cube is built over, the ones present in the frame are used.
+# "day" is the time column binned to an integer day index (days since
+# 1970-01-01), coarser periods roll up from it.
+CUBE_DIMS = [
+    "day",
+    "patho_name",
+    "sample_type",
+    "gender",
+    "age_group",
+    "department",
+]
+
+# Periods a cube can roll "day" up to
+CUBE_PERIODS = ["day", "week", "month", "quarter"]
+
+
+class CountCube(NamedTuple):
+    # One row per observed combination of dims (missing values included),
+    # with the number of rows in "count"
+    cells: pd.DataFrame
+    dims: List[str]
+
+
+def day_index(times: pd.Series) -> pd.Series:
+    """
+    Bin datetimes into days since 1970-01-01, as nullable Int32.
+    """
+    days = times.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    return pd.Series(
+        pd.arrays.IntegerArray(days.astype(np.int32), np.isnat(days)),
+        index=times.index,
+        name=times.name,
+    )
+
+
+def build_cube(
+    df: pd.DataFrame,
+    dims: Sequence[str] = CUBE_DIMS,
+    distinct: Optional[str] = None,
+    time_column: str = "collect_time",
+) -> CountCube:
+    """
+    Count the rows of df per combination of dims, in a single groupby.
+    Input:
+        1. df: sample frame, or sample-left-join etiology frame, with
+           time_column for the "day" dim
+        2. dims: dimensions to count over, those missing from df are skipped
+        3. distinct: count distinct values of this column instead of rows
+           (e.g. "sample_name" on a merged frame). Only valid for dims that
+           do not vary within a distinct value, like the sample attributes.
+        4. time_column: datetime column binned into the "day" dim, e.g.
+           "collect_time" or "receive_time"
+    Return:
+        1. CountCube
+    """
+    if distinct is not None:
+        df = df.drop_duplicates(distinct)
+    keys = {}
+    for dim in dims:
+        if dim == "day" and time_column in df.columns:
+            keys[dim] = day_index(df[time_column])
+        elif dim in df.columns:
+            keys[dim] = df[dim]
+    if not keys:
+        return CountCube(pd.DataFrame({"count": [len(df)]}), [])
+
+    counts = (
+        pd.DataFrame(keys)
+        .groupby(list(keys), observed=True, dropna=False, sort=False)
+        .size()
+    )
+    return CountCube(counts.reset_index(name="count"), list(keys))
+
+
+def merge_cubes(cube: CountCube, other: CountCube) -> CountCube:
+    """
+    Add the counts of two cubes of the same dims, e.g. the cube of a dataset
+    and the cube of the rows appended to it. Categorical dims get the sorted
+    union of their categories, as concat_frames gives the appended frame.
+    """
+    if cube.dims != other.dims:
+        raise ValueError(f"Cannot merge cubes of dims {cube.dims} and {other.dims}")
+    if not cube.dims:
+        return CountCube(cube.cells + other.cells, [])
+    cells = concat_frames([cube.cells, other.cells])
+    counts = cells.groupby(cube.dims, observed=True, dropna=False, sort=False)[
+        "count"
+    ].sum()
+    return CountCube(counts.reset_index(name="count"), cube.dims)
+
+
+def _day_labels(days: np.ndarray, period: str) -> np.ndarray:
+    dates = days.astype("datetime64[D]")
+    if period == "day":
+        return np.datetime_as_string(dates, unit="D")
+    if period == "week":
+        iso = pd.DatetimeIndex(dates).isocalendar()
+        return np.array(
+            [f"{year}-W{week:02d}" for year, week in zip(iso["year"], iso["week"])]
+        )
+    months = dates.astype("datetime64[M]")
+    if period == "month":
+        return np.datetime_as_string(months, unit="M")
+    return np.array(
+        [f"{1970 + m // 12}-Q{m % 12 // 3 + 1}" for m in months.astype(np.int64)]
+    )
+
+
+def period_labels(days: pd.Series, period: str) -> pd.Series:
+    """
+    Label day indexes of day_index by period of CUBE_PERIODS, e.g.
+    "2024-01-31", "2024-W05", "2024-01" or "2024-Q1". Labels are made once
+    per distinct day, not per row.
+    """
+    valid = days.notna().to_numpy()
+    distinct_days, inverse = np.unique(
+        days.to_numpy(dtype=np.int64, na_value=0)[valid], return_inverse=True
+    )
+    labels = np.full(len(days), None, dtype=object)
+    labels[valid] = _day_labels(distinct_days, period)[inverse]
+    return pd.Series(labels, index=days.index)
+
+
+def _select(cube: CountCube, where: Optional[Dict[str, List]]) -> pd.DataFrame:
+    cells = cube.cells
+    if where:
+        mask = pd.Series(True, index=cells.index)
+        for dim, values in where.items():
+            mask &= cells[dim].isin(values)
+        cells = cells[mask]
+    return cells
+
+
+def _dim_values(cells: pd.DataFrame, dim: str) -> pd.Series:
+    if dim in CUBE_PERIODS:
+        return period_labels(cells["day"], dim).rename(dim)
+    return cells[dim]
+
+
+def rollup(
+    cube: CountCube,
+    by: Sequence[str],
+    where: Optional[Dict[str, List]] = None,
+) -> pd.DataFrame:
+    """
+    Sum the counts of a cube over every dim not in by. Cost depends on the
+    number of cells, not on the number of rows the cube was built from.
+    Input:
+        1. cube: CountCube
+        2. by: dims to keep, a period of CUBE_PERIODS (e.g. "week") stands
+           for "day" rolled up to that period, labelled as str
+        3. where: only count the cells whose dim value is in the given list
+    Return:
+        1. pd.DataFrame, by columns + "count", sorted by the by columns.
+           Combinations with a missing value are dropped, as in groupby.
+    """
+    cells = _select(cube, where)
+    if not by:
+        return pd.DataFrame({"count": [cells["count"].sum()]})
+    return (
+        cells["count"]
+        .groupby([_dim_values(cells, dim) for dim in by], observed=True)
+        .sum()
+        .reset_index(name="count")
+    )
+
+
+def count_matrix(
+    cube: CountCube,
+    rows: str,
+    columns: str,
+    where: Optional[Dict[str, List]] = None,
+) -> Tuple[pd.Index, pd.Index, np.ndarray]:
+    """
+    Sum the counts of a cube into a dense rows x columns matrix, by counting
+    the integer codes of the two dims with np.bincount.
+    Input:
+        1. cube: CountCube
+        2. rows, columns: dims of the matrix, or a period of CUBE_PERIODS
+        3. where: see rollup
+    Return:
+        1. pd.Index, sorted labels of the rows
+        2. pd.Index, sorted labels of the columns
+        3. np.ndarray of int64 counts, labels of cells with a missing row or
+           column value are left out
+    """
+    cells = _select(cube, where)
+    row_values = _dim_values(cells, rows)
+    column_values = _dim_values(cells, columns)
+    valid = (row_values.notna() & column_values.notna()).to_numpy()
+    row_codes, row_labels = pd.factorize(row_values[valid], sort=True)
+    column_codes, column_labels = pd.factorize(column_values[valid], sort=True)
+    n_rows, n_columns = len(row_labels), len(column_labels)
+    counts = np.bincount(
+        row_codes * n_columns + column_codes,
+        weights=cells["count"].to_numpy()[valid],
+        minlength=n_rows * n_columns,
+    )
+    return (
+        pd.Index(row_labels, name=rows),
+        pd.Index(column_labels, name=columns),
+        counts.astype(np.int64).reshape(n_rows, n_columns),
+    )
+
+
+class Ranking(NamedTuple):
+    # Code space of a column (its categories), and the codes of the observed
+    # values, most frequent first, with their counts
+    categories: pd.Index
+    codes: np.ndarray
+    counts: np.ndarray
+
+    def top(self, n: Optional[int] = None) -> pd.Index:
+        """
+        Get the n most frequent values, all observed values for None.
+        """
+        return self.categories[self.codes[:n]]
+
+    def mask(self, values: pd.Series, selected: Sequence) -> np.ndarray:
+        """
+        Get the rows of values that are in selected. Categorical values with
+        the categories of the ranking are looked up by their integer codes
+        instead of comparing strings.
+        """
+        if not (
+            isinstance(values.dtype, pd.CategoricalDtype)
+            and values.cat.categories.equals(self.categories)
+        ):
+            return values.isin(selected).to_numpy()
+        lookup = np.zeros(len(self.categories) + 1, dtype=bool)
+        lookup[self.categories.get_indexer(pd.Index(selected))] = True
+        # Code -1 (missing) reads the last entry, which selected values not
+        # in the categories may have set
+        lookup[-1] = False
+        return lookup[values.cat.codes.to_numpy()]
+
+
+def build_ranking(values: pd.Series) -> Ranking:
+    """
+    Rank the values of a column by frequency, in one pass over its codes.
+    Ties keep the order of the categories (sorted values otherwise), as
+    Series.nlargest does on sorted counts.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = values.cat.categories
+        codes = values.cat.codes.to_numpy()
+    else:
+        codes, categories = pd.factorize(values, sort=True)
+    counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+    order = np.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0]
+    return Ranking(pd.Index(categories), order, counts[order])
+
+
+def merge_rankings(
+    ranking: Ranking, other: Ranking, categories: Optional[pd.Index] = None
+) -> Ranking:
+    """
+    Add the counts of two rankings of a column, e.g. the ranking of a dataset
+    and the ranking of the rows appended to it.
+    Input:
+        1. ranking, other: Ranking of the two parts
+        2. categories: categories of the combined column, the sorted union
+           of both code spaces for None
+    Return:
+        1. Ranking, same as build_ranking on the combined column
+    """
+    if categories is None:
+        categories = ranking.categories.union(other.categories)
+    counts = np.zeros(len(categories), dtype=np.int64)
+    for part in (ranking, other):
+        codes = categories.get_indexer(part.categories[part.codes])
+        if (codes < 0).any():
+            raise ValueError("Ranked values missing from the categories")
+        np.add.at(counts, codes, part.counts)
+    order = np.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0]
+    return Ranking(pd.Index(categories), order, counts[order])
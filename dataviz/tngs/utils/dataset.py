@@ -0,0 +1,607 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from utils.aggregate import (
+    DatasetAggregates,
+    aggregates_from_dict,
+    aggregates_to_dict,
+    compute_aggregates,
+    update_aggregates,
+)
+from utils.constants import (
+    DATASET_CACHE_MAX_MB,
+    INGEST_MAX_MEMORY_MB,
+    INGEST_MAX_PROCESSES,
+    INGEST_STREAMING,
+    WORKBOOK_SHEETS,
+)
+from utils.cube import (
+    CountCube,
+    Ranking,
+    build_cube,
+    build_ranking,
+    merge_cubes,
+    merge_rankings,
+)
+from utils.ingest import parse_workbook, parse_workbook_bytes
+from utils.join import JoinIndex, build_join_index, merge_by_index, sample_keys
+from utils.registry import DatasetRegistry
+from utils.schema import WORKBOOK_SCHEMAS, CoercionReport, concat_frames
+from utils.store import (
+    has_dataset,
+    read_aggregates,
+    read_coercion_reports,
+    read_sheet,
+    write_dataset,
+)
+from utils.text import TokenIndex, build_token_index, token_frequencies
+
+
+def file_digest(file) -> str:
+    """
+    Get the sha256 digest of an uploaded file content.
+    The digest is remembered per uploaded file so a 40 MB workbook is only
+    hashed once, not on every rerun.
+    """
+    file_id = getattr(file, "file_id", None)
+    if st.session_state.get("_uploaded_digests") is None:
+        st.session_state._uploaded_digests = {}
+    digests = st.session_state._uploaded_digests
+    if file_id is not None and file_id in digests:
+        return digests[file_id]
+
+    digest = hashlib.sha256(file.getvalue()).hexdigest()
+    if file_id is not None:
+        digests[file_id] = digest
+    return digest
+
+
+class TngsWorkbook(NamedTuple):
+    sample: pd.DataFrame
+    etiology: pd.DataFrame
+    drugresis: pd.DataFrame
+    # Sample-left-join row offsets, built once per dataset from integer
+    # sample keys
+    etiology_join: JoinIndex
+    drugresis_join: JoinIndex
+    aggregates: DatasetAggregates
+    # Sheet name -> cells that could not be coerced when the workbook was
+    # parsed, empty for datasets combined from other datasets
+    coercion_reports: Dict[str, CoercionReport]
+
+    def frames(self) -> Dict[str, pd.DataFrame]:
+        return {sheet_name: getattr(self, sheet_name) for sheet_name in WORKBOOK_SHEETS}
+
+    def nbytes(self) -> int:
+        return sum(_sizeof(df) for df in self.frames().values()) + sum(
+            join.left.nbytes + join.right.nbytes
+            for join in (self.etiology_join, self.drugresis_join)
+        )
+
+
+def _sizeof(value) -> int:
+    if isinstance(value, TngsWorkbook):
+        return value.nbytes()
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, TokenIndex):
+        counts = value.counts
+        return int(
+            counts.data.nbytes
+            + counts.indices.nbytes
+            + counts.indptr.nbytes
+            + value.tokens.memory_usage(deep=True)
+        )
+    if isinstance(value, CountCube):
+        return int(value.cells.memory_usage(deep=True).sum())
+    if isinstance(value, Ranking):
+        return int(
+            value.categories.memory_usage(deep=True)
+            + value.codes.nbytes
+            + value.counts.nbytes
+        )
+    return 0
+
+
+# One immutable copy of every parsed workbook, shared by all sessions. The
+# frames it hands out must not be modified in place.
+_registry = DatasetRegistry(
+    DATASET_CACHE_MAX_MB * 2**20 if DATASET_CACHE_MAX_MB else None, _sizeof
+)
+
+
+def _dataset_key(digest: str) -> str:
+    # Same file content parsed with another schema is another dataset
+    schema = tuple(
+        (
+            sheet_name,
+            tuple(sorted(dtype.items())),
+            tuple(columns),
+            tuple(sorted(WORKBOOK_SCHEMAS[sheet_name].items())),
+        )
+        for sheet_name, (dtype, columns) in WORKBOOK_SHEETS.items()
+    )
+    schema_hash = hashlib.sha256(repr(schema).encode()).hexdigest()[:16]
+    return f"{digest}-{schema_hash}"
+
+
+def _build_workbook(
+    frames: Dict[str, pd.DataFrame],
+    aggregates: Optional[DatasetAggregates] = None,
+    coercion_reports: Optional[Dict[str, CoercionReport]] = None,
+) -> TngsWorkbook:
+    joins = {}
+    for sheet_name in ("etiology", "drugresis"):
+        sample_key, child_key = sample_keys(frames["sample"], frames[sheet_name])
+        joins[f"{sheet_name}_join"] = build_join_index(sample_key, child_key)
+    if aggregates is None:
+        aggregates = compute_aggregates(frames["sample"], frames["etiology"])
+    return TngsWorkbook(
+        **frames,
+        **joins,
+        aggregates=aggregates,
+        coercion_reports=coercion_reports or {},
+    )
+
+
+def _parse_workbook(file, streaming: bool) -> TngsWorkbook:
+    file.seek(0)
+    if not streaming:
+        with st.spinner("Parsing workbook..."):
+            return _build_workbook(*parse_workbook(file, streaming=False))
+
+    progress_bar = st.progress(0.0, text="Parsing workbook...")
+
+    def _progress(sheet_name, rows_done, total_rows, elapsed):
+        rate = rows_done / elapsed if elapsed > 0 else 0
+        fraction = min(rows_done / total_rows, 1.0) if total_rows else 0.0
+        progress_bar.progress(
+            fraction,
+            text=f"Parsing sheet '{sheet_name}': {rows_done} rows "
+            f"({rate:,.0f} rows/s)",
+        )
+
+    try:
+        frames, coercion_reports = parse_workbook(
+            file,
+            streaming=True,
+            max_memory_mb=INGEST_MAX_MEMORY_MB,
+            progress=_progress,
+        )
+    finally:
+        progress_bar.empty()
+    return _build_workbook(frames, coercion_reports=coercion_reports)
+
+
+def _read_stored_workbook(key: str) -> TngsWorkbook:
+    aggregates = read_aggregates(key)
+    return _build_workbook(
+        {sheet_name: read_sheet(key, sheet_name) for sheet_name in WORKBOOK_SHEETS},
+        aggregates=None if aggregates is None else aggregates_from_dict(aggregates),
+        coercion_reports=read_coercion_reports(key),
+    )
+
+
+def _write_workbook(key: str, workbook: TngsWorkbook):
+    # The aggregates are stored too, reloading the dataset does not scan it
+    write_dataset(
+        key,
+        workbook.frames(),
+        workbook.coercion_reports,
+        aggregates_to_dict(workbook.aggregates),
+    )
+
+
+def workbook_key(file) -> str:
+    """
+    Get the dataset key of an uploaded workbook (content digest + schema).
+    """
+    return _dataset_key(file_digest(file))
+
+
+def load_workbook(file, streaming: bool = INGEST_STREAMING) -> TngsWorkbook:
+    """
+    Load the sample, etiology and drugresis sheets of the uploaded workbook.
+    Input:
+        1. file: the uploaded xlsx file
+        2. streaming: walk rows with openpyxl's read-only iterator into typed
+           column chunks (bounded memory, progress in the UI) instead of
+           pd.read_excel
+    Return:
+        1. TngsWorkbook with the typed and projected sample, etiology and
+           drugresis frames. Looked up in the shared registry first, then in the
+           Parquet store, and only parsed from xlsx (in a single pass) when the
+           content has never been seen. Afterwards it can be fetched with
+           get_workbook(workbook_key(file)).
+    """
+    key = workbook_key(file)
+    workbook = _registry.get(key)
+    if workbook is not None:
+        return workbook
+
+    if has_dataset(key, WORKBOOK_SHEETS):
+        workbook = _read_stored_workbook(key)
+    else:
+        workbook = _parse_workbook(file, streaming)
+        _write_workbook(key, workbook)
+
+    return _registry.put(key, workbook)
+
+
+def get_workbook(key: str) -> TngsWorkbook:
+    """
+    Get a loaded dataset by its key, from memory or from the Parquet store.
+    Raise KeyError if the dataset is gone from both.
+    """
+    workbook = _registry.get(key)
+    if workbook is not None:
+        return workbook
+
+    if not has_dataset(key, WORKBOOK_SHEETS):
+        raise KeyError("The dataset is no longer available, please upload it again.")
+    return _registry.put(key, _read_stored_workbook(key))
+
+
+def hold_workbook(key: str) -> TngsWorkbook:
+    """
+    Get a dataset like get_workbook, and keep it in the shared registry while
+    the session uses it. The session holds one dataset at a time, holding
+    another one releases the previous one.
+    """
+    handle = st.session_state.get("_dataset_handle")
+    if handle is None or handle.key != key:
+        handle = _registry.acquire(key, lambda: get_workbook(key))
+        st.session_state._dataset_handle = handle
+    return handle.value
+
+
+def load_sheet(
+    key: str, sheet_name: str, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    Load one sheet of a dataset, optionally only some columns.
+    Input:
+        1. key: dataset key
+        2. sheet_name: "sample", "etiology" or "drugresis"
+        3. columns: columns the page needs, None for the whole sheet
+    Return:
+        1. pd.DataFrame, shared by every session with the same dataset and
+           columns, not to be modified in place
+    """
+    df = getattr(hold_workbook(key), sheet_name)
+    if columns is None or list(df.columns) == list(columns):
+        return df
+    return _registry.derive(
+        key, ("sheet", sheet_name, tuple(columns)), lambda: df.loc[:, columns]
+    )
+
+
+def merged_sheet(key: str, sheet_name: str) -> pd.DataFrame:
+    """
+    Load the sample-left-join of the etiology or drugresis sheet of a dataset.
+    Return:
+        1. pd.DataFrame, same rows and columns as
+           `df_sample.merge(df_child, on="sample_name", how="left")`, built
+           once and shared by every session with the same dataset, not to be
+           modified in place
+    """
+    workbook = hold_workbook(key)
+    return _registry.derive(
+        key,
+        ("merge", sheet_name),
+        lambda: merge_by_index(
+            workbook.sample,
+            # Datasets stored before only the sample sheet was tagged also
+            # have source_file on the child sheets, it comes from the sample
+            getattr(workbook, sheet_name).drop(columns="source_file", errors="ignore"),
+            getattr(workbook, f"{sheet_name}_join"),
+            on="sample_name",
+        ),
+    )
+
+
+def view_cube(
+    key: str, sheet_name: str, df_view: pd.DataFrame, time_column: str = "collect_time"
+) -> CountCube:
+    """
+    Get the count cube of a grid view of a dataset sheet.
+    Input:
+        1. key: dataset key
+        2. sheet_name: "sample" for the sample sheet, "etiology" or
+           "drugresis" for their sample-left-join frames
+        3. df_view: rows of the sheet the grid returned (filtered and sorted)
+        4. time_column: datetime column of the "day" dim
+    Return:
+        1. CountCube of df_view. A grid view only drops or reorders rows, so
+           a view with every row of the sheet has the cube of the whole sheet,
+           built once per dataset and shared by every session.
+    """
+    if sheet_name == "sample":
+        df_sheet = load_sheet(key, "sample")
+    else:
+        df_sheet = merged_sheet(key, sheet_name)
+    if len(df_view) != len(df_sheet):
+        return build_cube(df_view, time_column=time_column)
+    return _registry.derive(
+        key,
+        ("cube", sheet_name, time_column),
+        lambda: build_cube(df_sheet, time_column=time_column),
+    )
+
+
+def view_ranking(
+    key: str, sheet_name: str, column: str, df_view: pd.DataFrame
+) -> Ranking:
+    """
+    Get the frequency ranking of a column of a grid view of a dataset sheet.
+    Input:
+        1. key, sheet_name, df_view: see view_cube
+        2. column: categorical column to rank, e.g. "patho_name"
+    Return:
+        1. Ranking of df_view[column]. A view with every row of the sheet has
+           the ranking of the whole sheet, built once per dataset and shared.
+    """
+    if sheet_name == "sample":
+        df_sheet = load_sheet(key, "sample")
+    else:
+        df_sheet = merged_sheet(key, sheet_name)
+    if len(df_view) != len(df_sheet):
+        return build_ranking(df_view[column])
+    return _registry.derive(
+        key,
+        ("ranking", sheet_name, column),
+        lambda: build_ranking(df_sheet[column]),
+    )
+
+
+def view_token_frequencies(
+    key: str, column: str, df_view: pd.DataFrame
+) -> Callable[[], Dict[str, int]]:
+    """
+    Get the word frequencies of a text column of a sample grid view.
+    Input:
+        1. key: dataset key
+        2. column: text column of the sample sheet, e.g. "clinical_diagnosis"
+        3. df_view: rows of the sample sheet the grid returned
+    Return:
+        1. function returning a dict of token -> count, it does not use the
+           session and can run in a worker thread. The column is tokenized
+           once per dataset and shared, the view only sums the rows it shows.
+           A view whose index does not point into the sheet is tokenized
+           itself.
+    """
+    df_sheet = load_sheet(key, "sample")
+    positions = df_view.index
+    if not (
+        pd.api.types.is_integer_dtype(positions.dtype)
+        and (
+            len(positions) == 0
+            or (positions.min() >= 0 and positions.max() < len(df_sheet))
+        )
+    ):
+        values = df_view[column]
+        return lambda: token_frequencies(build_token_index(values))
+
+    index = _registry.derive(
+        key, ("tokens", column), lambda: build_token_index(df_sheet[column])
+    )
+    rows = None if len(df_view) == len(df_sheet) else positions.to_numpy()
+    return lambda: token_frequencies(index, rows)
+
+
+def registry_stats() -> Dict[str, int]:
+    """
+    Get the number of shared datasets, their bytes and the number of session
+    handles on them.
+    """
+    return _registry.stats()
+
+
+def _with_source_file(df: pd.DataFrame, source_file: str) -> pd.DataFrame:
+    return df.assign(
+        source_file=pd.Categorical.from_codes(
+            np.zeros(len(df), dtype=np.int8), categories=[source_file]
+        )
+    )
+
+
+def _append_frames(
+    base: Dict[str, pd.DataFrame], delta: Dict[str, pd.DataFrame]
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]:
+    # Samples already in the dataset are kept as they are, together with their
+    # etiology rows; drug resistance rows are deduped on drug_resistance_id
+    sample_name = delta["sample"]["sample_name"]
+    new_sample = ~sample_name.isin(base["sample"]["sample_name"])
+    new_sample &= ~sample_name.duplicated()
+    resistance_id = delta["drugresis"]["drug_resistance_id"]
+    new_rows = {
+        "sample": delta["sample"][new_sample],
+        "etiology": delta["etiology"][
+            delta["etiology"]["sample_name"].isin(sample_name[new_sample])
+        ],
+        "drugresis": delta["drugresis"][
+            ~resistance_id.isin(base["drugresis"]["drug_resistance_id"])
+            & ~resistance_id.duplicated()
+        ],
+    }
+    frames = {
+        sheet_name: concat_frames([base[sheet_name], df_new])
+        for sheet_name, df_new in new_rows.items()
+    }
+    return frames, new_rows
+
+
+def _fold_derived(
+    base_key: str,
+    key: str,
+    workbook: TngsWorkbook,
+    new_rows: Dict[str, pd.DataFrame],
+):
+    # Fold the appended rows into the merged sheets, cubes and rankings
+    # already derived from the base dataset, instead of deriving them again
+    # from every row. A merged sheet only folds when no base sample gains
+    # child rows and no base child row gains a sample.
+    df_new_sample = new_rows["sample"]
+    n_base = len(workbook.sample) - len(df_new_sample)
+    base_names = workbook.sample["sample_name"].iloc[:n_base]
+    delta_frames = {"sample": df_new_sample}
+    for sheet_name in ("etiology", "drugresis"):
+        df_child = getattr(workbook, sheet_name)
+        df_new_child = new_rows[sheet_name]
+        df_base_child = df_child.iloc[: len(df_child) - len(df_new_child)]
+        if (
+            df_new_child["sample_name"].isin(base_names).any()
+            or df_base_child["sample_name"].isin(df_new_sample["sample_name"]).any()
+        ):
+            continue
+        df_new_child = df_new_child.drop(columns="source_file", errors="ignore")
+        join = build_join_index(*sample_keys(df_new_sample, df_new_child))
+        delta_frames[sheet_name] = merge_by_index(df_new_sample, df_new_child, join)
+
+    for name, value in _registry.derived(base_key).items():
+        if name[0] not in ("merge", "cube", "ranking") or name[1] not in delta_frames:
+            continue
+        sheet_name = name[1]
+        df_delta = delta_frames[sheet_name]
+        if name[0] == "merge":
+            # Columns in the order of merge_by_index on the appended sheets
+            columns = list(workbook.sample.columns) + [
+                column
+                for column in getattr(workbook, sheet_name).columns
+                if column not in workbook.sample.columns and column != "source_file"
+            ]
+            folded = concat_frames([value, df_delta])[columns]
+        elif name[0] == "cube":
+            folded = merge_cubes(value, build_cube(df_delta, time_column=name[2]))
+        else:
+            # The combined column has the categories of the appended sheet
+            # it comes from
+            column = name[2]
+            df_sheet = (
+                workbook.sample
+                if column in workbook.sample.columns
+                else getattr(workbook, sheet_name)
+            )
+            categories = None
+            if isinstance(df_sheet[column].dtype, pd.CategoricalDtype):
+                categories = df_sheet[column].cat.categories
+            folded = merge_rankings(value, build_ranking(df_delta[column]), categories)
+        _registry.derive(key, name, lambda: folded)
+
+
+def append_workbook(base_key: str, files: List) -> str:
+    """
+    Append delta workbooks (same layout as a full upload) to a dataset.
+    Input:
+        1. base_key: key of the current dataset
+        2. files: the uploaded delta xlsx files, loaded with load_workbooks
+    Return:
+        1. str, key of the appended dataset. Rows whose sample_name (sample,
+           etiology) or drug_resistance_id (drugresis) is already in the
+           dataset are dropped. The dataset aggregates, and the merged
+           sheets, cubes and rankings already derived from the base dataset,
+           are updated with the new rows only.
+    """
+    delta_key = load_workbooks(files)
+    key = hashlib.sha256(f"{base_key}+{delta_key}".encode()).hexdigest()
+    if _registry.get(key) is not None or has_dataset(key, WORKBOOK_SHEETS):
+        return key
+
+    base = get_workbook(base_key)
+    delta = get_workbook(delta_key).frames()
+    if "source_file" in base.sample.columns and len(files) == 1:
+        source_file = getattr(files[0], "name", delta_key)
+        delta["sample"] = _with_source_file(delta["sample"], source_file)
+    frames, new_rows = _append_frames(base.frames(), delta)
+    aggregates = update_aggregates(
+        base.aggregates, new_rows["sample"], new_rows["etiology"]
+    )
+    workbook = _build_workbook(frames, aggregates=aggregates)
+    _write_workbook(key, workbook)
+    workbook = _registry.put(key, workbook)
+    _fold_derived(base_key, key, workbook, new_rows)
+    return key
+
+
+def _load_new_workbooks(files: List, streaming: bool):
+    # Parse the workbooks that are neither cached nor stored in a process
+    # pool, openpyxl parsing is CPU bound and holds the GIL
+    new_files = [
+        file
+        for file in files
+        if _registry.get(workbook_key(file)) is None
+        and not has_dataset(workbook_key(file), WORKBOOK_SHEETS)
+    ]
+    if len(new_files) < 2:
+        return
+
+    max_workers = min(len(new_files), INGEST_MAX_PROCESSES or os.cpu_count() or 1)
+    progress_bar = st.progress(0.0, text=f"Parsing {len(new_files)} workbooks...")
+    # spawn, forking the multi-threaded streamlit server is not safe
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(
+                parse_workbook_bytes, file.getvalue(), streaming, INGEST_MAX_MEMORY_MB
+            ): file
+            for file in new_files
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            file = futures[future]
+            frames, coercion_reports = future.result()
+            workbook = _build_workbook(frames, coercion_reports=coercion_reports)
+            key = workbook_key(file)
+            _write_workbook(key, workbook)
+            _registry.put(key, workbook)
+            progress_bar.progress(
+                done / len(new_files), text=f"Parsed {getattr(file, 'name', key)}"
+            )
+    progress_bar.empty()
+
+
+def load_workbooks(files: List, streaming: bool = INGEST_STREAMING) -> str:
+    """
+    Load several uploaded workbooks (e.g. one per hospital) as one dataset.
+    Input:
+        1. files: the uploaded xlsx files
+        2. streaming: see load_workbook
+    Return:
+        1. str, dataset key. A single file gives the dataset of load_workbook;
+           several files are parsed concurrently and concatenated, with their
+           categorical dictionaries unioned and a categorical source_file
+           column holding the uploaded file name of every sample. The merged
+           sheets get it from the sample sheet.
+    """
+    keys = [workbook_key(file) for file in files]
+    if len(files) == 1:
+        load_workbook(files[0], streaming=streaming)
+        return keys[0]
+
+    key = hashlib.sha256("+".join(keys).encode()).hexdigest()
+    if _registry.get(key) is not None or has_dataset(key, WORKBOOK_SHEETS):
+        return key
+
+    _load_new_workbooks(files, streaming)
+    workbooks = [load_workbook(file, streaming=streaming) for file in files]
+    frames = {}
+    for sheet_name in WORKBOOK_SHEETS:
+        parts = []
+        for file, workbook in zip(files, workbooks):
+            df = getattr(workbook, sheet_name)
+            if sheet_name == "sample":
+                source_file = getattr(file, "name", workbook_key(file))
+                df = _with_source_file(df, source_file)
+            parts.append(df)
+        frames[sheet_name] = concat_frames(parts)
+
+    workbook = _build_workbook(frames)
+    _write_workbook(key, workbook)
+    _registry.put(key, workbook)
+    return key
@@ -0,0 +1,182 @@
+import hashlib
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+import matplotlib.figure
+import matplotlib.pyplot as plt
+from plotly.graph_objs import Figure
+from utils.constants import FIGURE_CACHE_MAX_MB, FIGURE_WORKERS
+from utils.grid import grid_filter_model
+
+logger = logging.getLogger(__name__)
+
+
+def grid_view_key(dataset_key: str, sheet_name: str, grid_response) -> str:
+    """
+    Identify the rows an AgGrid shows of a dataset sheet.
+    Input:
+        1. dataset_key: key of the dataset given to the grid
+        2. sheet_name: sheet (or merged sheet) shown by the grid, unfiltered
+           grids of different sheets have the same filter model
+        3. grid_response: AgGridReturn of the grid
+    Return:
+        1. str, the same for every session with the same dataset, sheet and
+           filter model. A grid that has not reported its state yet shows
+           the whole sheet, like an empty filter model. The rows themselves
+           are never hashed.
+    """
+    filter_model = grid_filter_model(getattr(grid_response, "grid_state", None))
+    view = json.dumps(filter_model, sort_keys=True, default=str)
+    return hashlib.sha256(f"{dataset_key}|{sheet_name}|{view}".encode()).hexdigest()
+
+
+def _figure_png(fig: matplotlib.figure.Figure) -> bytes:
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+def _sizeof(value) -> int:
+    if isinstance(value, Figure):
+        return len(value.to_json())
+    if isinstance(value, bytes):
+        return len(value)
+    return 0
+
+
+class FigureCache:
+    """
+    Process-wide LRU of built figures, bounded by the size of their
+    serialised form. Plotly figures are kept as figures, matplotlib figures
+    as PNG bytes. Cached figures are shared and must not be modified.
+    """
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value):
+        nbytes = _sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            self._entries[key] = value
+            self._sizes[key] = nbytes
+            self._nbytes += nbytes
+            while self.max_bytes is not None and self._nbytes > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self._nbytes -= self._sizes.pop(evicted)
+            return value
+
+
+_figure_cache = FigureCache(
+    FIGURE_CACHE_MAX_MB * 2**20 if FIGURE_CACHE_MAX_MB else None
+)
+
+
+def cached_figure(view_key: str, func: Callable, data, *args, **kwargs):
+    """
+    Build a figure once per data view and chart parameters.
+    Input:
+        1. view_key: identifies data, e.g. grid_view_key
+        2. func: chart function, called as func(data, *args, **kwargs)
+        3. data: the data of view_key, or a callable returning it, only
+           called when the figure is not cached
+        4. args, kwargs: chart parameters, part of the cache key
+    Return:
+        1. plotly Figure, or PNG bytes for a matplotlib figure
+    """
+    key = (
+        view_key,
+        f"{func.__module__}.{func.__qualname__}",
+        repr(args),
+        repr(sorted(kwargs.items())),
+    )
+    value = _figure_cache.get(key)
+    if value is not None:
+        return value
+
+    if callable(data):
+        data = data()
+    value = func(data, *args, **kwargs)
+    if isinstance(value, matplotlib.figure.Figure):
+        value = _figure_png(value)
+    return _figure_cache.put(key, value)
+
+
+_figure_executor = ThreadPoolExecutor(
+    max_workers=FIGURE_WORKERS, thread_name_prefix="figure"
+)
+
+
+def submit_figure(view_key: str, func: Callable, data, *args, **kwargs) -> Future:
+    """
+    Run cached_figure in a worker thread, so independent figures compute
+    concurrently while the script draws. func and data must not use
+    streamlit.
+    """
+    return _figure_executor.submit(cached_figure, view_key, func, data, *args, **kwargs)
+
+
+def cancel_figures(jobs: Optional[Dict[Hashable, Future]]):
+    """
+    Drop the figure jobs of a previous run that did not start yet, e.g. when
+    the user reruns the page before they completed. Started jobs still
+    finish and fill the cache.
+    """
+    for future in (jobs or {}).values():
+        future.cancel()
+
+
+def completed_figures(
+    jobs: Dict[Hashable, Future]
+) -> Iterator[Tuple[Hashable, Future]]:
+    """
+    Yield (name, future) of figure jobs as they complete, so each figure is
+    drawn as soon as it is ready.
+    """
+    names = {future: name for name, future in jobs.items()}
+    for future in as_completed(names):
+        yield names[future], future
+
+
+def draw_figures(jobs: Dict[Hashable, Future], charts: Dict, labels: Dict):
+    """
+    Draw figure jobs into their placeholders as they complete.
+    Input:
+        1. jobs: name -> future of submit_figure
+        2. charts: name -> streamlit placeholder of the figure
+        3. labels: name -> label of the figure in error messages
+    An error only replaces the figure it comes from, the other figures are
+    still drawn.
+    """
+    for name, job in completed_figures(jobs):
+        try:
+            fig = job.result()
+        except ValueError as e:
+            charts[name].info(f"Cannot plot {labels[name]}: {e}")
+            continue
+        except Exception as e:
+            logger.exception("Plotting %s failed", labels[name])
+            charts[name].error(f"Plotting {labels[name]} failed: {e}")
+            continue
+        if isinstance(fig, bytes):
+            charts[name].image(fig, use_column_width=True)
+        else:
+            charts[name].plotly_chart(fig, use_container_width=True)
@@ -0,0 +1,499 @@
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from functools import cached_property
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from utils.constants import GRID_FILTER_CACHE_ENTRIES, GRID_ROW_DATA_CACHE_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+
+def grid_sort_model(grid_state: Optional[Dict]) -> List[Dict]:
+    """
+    Get the sort model ([{"colId": ..., "sort": "asc" | "desc"}, ...]) of an
+    AgGrid state, empty when the grid is not sorted.
+    """
+    return ((grid_state or {}).get("sort") or {}).get("sortModel") or []
+
+
+def sort_positions(df: pd.DataFrame, sort_model: List[Dict]) -> Optional[np.ndarray]:
+    """
+    Sort the rows of df by an AgGrid sort model.
+    Input:
+        1. df: frame shown by the grid
+        2. sort_model: see grid_sort_model, columns not in df are ignored
+    Return:
+        1. np.ndarray of row positions in sorted order, None when unsorted.
+           Missing values go last, ties keep the order of df.
+    """
+    sort_model = [s for s in sort_model if s.get("colId") in df.columns]
+    if not sort_model:
+        return None
+    order = df[[s["colId"] for s in sort_model]].reset_index(drop=True)
+    order = order.sort_values(
+        [s["colId"] for s in sort_model],
+        ascending=[s.get("sort") != "desc" for s in sort_model],
+        kind="stable",
+        na_position="last",
+    )
+    return order.index.to_numpy()
+
+
+def grid_filter_model(grid_state: Optional[Dict]) -> Dict:
+    """
+    Get the filter model ({colId: column filter model}) of an AgGrid state,
+    empty when the grid is not filtered.
+    """
+    return ((grid_state or {}).get("filter") or {}).get("filterModel") or {}
+
+
+def _js_string(value) -> Optional[str]:
+    # Cell value as the grid shows it, the rows are sent as JSON
+    if value is None or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return None
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+    if isinstance(value, (bool, np.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return str(value)
+
+
+def _distinct_strings(values: pd.Series):
+    # Codes of the rows (-1 for missing) and the grid strings of the distinct
+    # values, so string filters run once per distinct value
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    strings = pd.Series([_js_string(value) for value in uniques], dtype=object)
+    return codes, strings
+
+
+def _by_distinct(codes: np.ndarray, distinct: np.ndarray, missing: bool):
+    lookup = np.append(np.asarray(distinct, dtype=bool), missing)
+    return lookup[codes]
+
+
+def _text_mask(values: pd.Series, condition: Dict) -> np.ndarray:
+    codes, strings = _distinct_strings(values)
+    kind = condition.get("type", "contains")
+    if kind in ("blank", "notBlank"):
+        blank = strings.isna() | (strings == "")
+        distinct = blank if kind == "blank" else ~blank
+        return _by_distinct(codes, distinct, kind == "blank")
+    # Text filters are case-insensitive
+    text = str(condition.get("filter") or "").lower()
+    lower = strings.str.lower()
+    tests = {
+        "contains": lambda: lower.str.contains(text, regex=False),
+        "notContains": lambda: ~lower.str.contains(text, regex=False),
+        "equals": lambda: lower == text,
+        "notEqual": lambda: lower != text,
+        "startsWith": lambda: lower.str.startswith(text),
+        "endsWith": lambda: lower.str.endswith(text),
+    }
+    if kind not in tests:
+        raise ValueError(f"Unsupported text filter type: {kind}")
+    distinct = tests[kind]().fillna(False).to_numpy(dtype=bool)
+    # Missing cells only pass the negative filters, as in the grid
+    return _by_distinct(codes, distinct, kind in ("notContains", "notEqual"))
+
+
+def _scalar_mask(values: pd.Series, low, high, kind: str) -> np.ndarray:
+    missing = values.isna().to_numpy()
+    if kind in ("blank", "notBlank"):
+        return missing if kind == "blank" else ~missing
+    tests = {
+        "equals": lambda: values == low,
+        "notEqual": lambda: values != low,
+        "lessThan": lambda: values < low,
+        "lessThanOrEqual": lambda: values <= low,
+        "greaterThan": lambda: values > low,
+        "greaterThanOrEqual": lambda: values >= low,
+        # Bounds are excluded, as with the default inRangeInclusive=false
+        "inRange": lambda: (values > low) & (values < high),
+    }
+    if kind not in tests:
+        raise ValueError(f"Unsupported filter type: {kind}")
+    return tests[kind]().fillna(False).to_numpy(dtype=bool) & ~missing
+
+
+def _number_mask(values: pd.Series, condition: Dict) -> np.ndarray:
+    return _scalar_mask(
+        pd.to_numeric(values, errors="coerce"),
+        condition.get("filter"),
+        condition.get("filterTo"),
+        condition.get("type", "equals"),
+    )
+
+
+def _date_mask(values: pd.Series, condition: Dict) -> np.ndarray:
+    # Dates are compared by day, the filter has no time of day
+    def day(value):
+        return None if value is None else pd.Timestamp(value).floor("D")
+
+    return _scalar_mask(
+        pd.to_datetime(values, errors="coerce", format="ISO8601").dt.floor("D"),
+        day(condition.get("dateFrom")),
+        day(condition.get("dateTo")),
+        condition.get("type", "equals"),
+    )
+
+
+def _set_mask(values: pd.Series, condition: Dict) -> np.ndarray:
+    selected = condition.get("values") or []
+    codes, strings = _distinct_strings(values)
+    distinct = strings.isin([value for value in selected if value is not None])
+    return _by_distinct(codes, distinct.to_numpy(), None in selected)
+
+
+_CONDITION_MASKS = {
+    "text": _text_mask,
+    "number": _number_mask,
+    "date": _date_mask,
+    "set": _set_mask,
+}
+
+
+def _column_mask(values: pd.Series, model: Dict) -> np.ndarray:
+    if model.get("filterType") == "multi":
+        mask = np.ones(len(values), dtype=bool)
+        for sub_model in model.get("filterModels") or []:
+            if sub_model:
+                mask &= _column_mask(values, sub_model)
+        return mask
+
+    # Two or more conditions joined by AND / OR
+    conditions = model.get("conditions")
+    if conditions is None and "condition1" in model:
+        conditions = [model["condition1"], model["condition2"]]
+    if conditions is not None:
+        masks = [
+            _column_mask(values, {"filterType": model.get("filterType"), **c})
+            for c in conditions
+        ]
+        if model.get("operator", "AND") == "OR":
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    mask_of = _CONDITION_MASKS.get(model.get("filterType"))
+    if mask_of is None:
+        raise ValueError(f"Unsupported filter: {model.get('filterType')}")
+    return mask_of(values, model)
+
+
+def evaluate_filter_model(df: pd.DataFrame, filter_model: Dict) -> np.ndarray:
+    """
+    Evaluate an AgGrid filter model on a frame, as vectorised masks.
+    Input:
+        1. df: frame shown by the grid
+        2. filter_model: see grid_filter_model. Text, number, date and set
+           filters, their AND / OR conditions and multi filters are supported.
+    Return:
+        1. np.ndarray of bool, the rows the grid keeps
+    Raise:
+        1. ValueError for a column or a filter that cannot be evaluated
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for column, model in filter_model.items():
+        if column not in df.columns:
+            raise ValueError(f"Cannot filter on unknown column: {column}")
+        mask &= _column_mask(df[column], model)
+    return mask
+
+
+class _MaskCache:
+    # Masks of the frames given to the grids, per frame and filter model
+    # hash. Frames are held weakly, a mask is dropped with its frame.
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, df: pd.DataFrame, filter_model: Dict) -> np.ndarray:
+        digest = hashlib.sha256(
+            json.dumps(filter_model, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        key = (id(df), digest)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is df:
+                self._entries.move_to_end(key)
+                return entry[1]
+        mask = evaluate_filter_model(df, filter_model)
+        mask.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (weakref.ref(df), mask)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return mask
+
+
+_mask_cache = _MaskCache(GRID_FILTER_CACHE_ENTRIES)
+
+
+def filter_mask(df: pd.DataFrame, filter_model: Dict) -> np.ndarray:
+    """
+    Memoised evaluate_filter_model, computed once per frame and filter model
+    for every session. The mask is read-only.
+    """
+    return _mask_cache.get(df, filter_model)
+
+
+def grid_view(df: pd.DataFrame, grid_response) -> pd.DataFrame:
+    """
+    Get the rows of df a grid keeps, by evaluating its filter model on the
+    Python side instead of reading the rows the grid sent back.
+    Input:
+        1. df: frame given to the grid
+        2. grid_response: AgGridReturn of the grid
+    Return:
+        1. pd.DataFrame, df itself when nothing is filtered out. The rows the
+           grid sent back when its filter model cannot be evaluated.
+    """
+    filter_model = grid_filter_model(getattr(grid_response, "grid_state", None))
+    if not filter_model:
+        return df
+    try:
+        mask = filter_mask(df, filter_model)
+    except ValueError as e:
+        logger.warning("Grid filter evaluated by the grid instead: %s", e)
+        return grid_response.data
+    return df if mask.all() else df[mask]
+
+
+class GridView:
+    """
+    Rows of a frame a paged grid shows, filtered and sorted on the Python
+    side. Pages are taken by position, the view itself is only materialised
+    when asked for.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        sort_model: List[Dict],
+        filter_model: Optional[Dict] = None,
+    ):
+        self.df = df
+        self.sort_model = sort_model
+        self.filter_model = filter_model or {}
+        rows = None
+        if self.filter_model:
+            mask = filter_mask(df, self.filter_model)
+            if not mask.all():
+                rows = np.flatnonzero(mask)
+        if rows is None:
+            self.positions = sort_positions(df, sort_model)
+        else:
+            order = sort_positions(df.iloc[rows], sort_model)
+            self.positions = rows if order is None else rows[order]
+
+    def __len__(self) -> int:
+        if self.positions is None:
+            return len(self.df)
+        return len(self.positions)
+
+    def page(self, page: int, page_size: int) -> pd.DataFrame:
+        """
+        Get the rows of a page, counted from 0.
+        """
+        start, stop = page * page_size, (page + 1) * page_size
+        if self.positions is None:
+            return self.df.iloc[start:stop]
+        return self.df.iloc[self.positions[start:stop]]
+
+    def frame(self) -> pd.DataFrame:
+        if self.positions is None:
+            return self.df
+        return self.df.iloc[self.positions]
+
+
+class PagedGridReturn:
+    """
+    AgGridReturn of a paged grid. data is the whole view, taken from the
+    Python copy of the frame rather than from the rows the grid sent back,
+    page_data the rows of the page shown. The other attributes are the ones
+    of the grid response.
+    """
+
+    def __init__(self, response, view: GridView, page_data: pd.DataFrame):
+        self.response = response
+        self.view = view
+        self.page_data = page_data
+
+    @property
+    def grid_state(self) -> Dict:
+        # The grid shows a page of an unfiltered view until it reports state
+        return self.response.grid_state or {}
+
+    @cached_property
+    def data(self) -> pd.DataFrame:
+        return self.view.frame()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def encode_runs(positions: np.ndarray) -> np.ndarray:
+    """
+    Run-length encode row positions.
+    Return:
+        1. np.ndarray of shape (runs, 2), the first position and the length
+           of every run of consecutive positions
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    if not len(positions):
+        return np.empty((0, 2), dtype=np.int64)
+    starts = np.r_[0, np.flatnonzero(np.diff(positions) != 1) + 1]
+    lengths = np.diff(np.r_[starts, len(positions)])
+    return np.column_stack([positions[starts], lengths])
+
+
+def decode_runs(runs: np.ndarray) -> np.ndarray:
+    """
+    Get the row positions of encode_runs runs.
+    """
+    if not len(runs):
+        return np.empty(0, dtype=np.int64)
+    starts, lengths = runs[:, 0], runs[:, 1]
+    # Position = run start + offset in the run
+    run_offsets = np.cumsum(np.r_[0, lengths[:-1]])
+    return np.repeat(starts - run_offsets, lengths) + np.arange(lengths.sum())
+
+
+class IndexedGridReturn:
+    """
+    AgGridReturn of a grid in index return mode. Only the ids of the rows
+    after filter and sort are read from the grid response, as runs of row
+    positions (the grid ids its rows by position in the frame it was given).
+    data rebuilds the view from the Python copy of the frame, the rows the
+    grid sent back are never decoded.
+    """
+
+    def __init__(self, response, df: pd.DataFrame):
+        self.response = response
+        self.df = df
+        ids = response.rows_id_after_sort_and_filter
+        self.runs = None if ids is None else encode_runs(np.asarray(ids, np.int64))
+
+    @cached_property
+    def data(self) -> pd.DataFrame:
+        if self.runs is None:
+            return self.df
+        if len(self.runs) == 1 and tuple(self.runs[0]) == (0, len(self.df)):
+            # Every row in the order of the frame
+            return self.df
+        return self.df.iloc[decode_runs(self.runs)]
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def _encode_values(values: pd.Series) -> Optional[np.ndarray]:
+    # JSON values of a column as an object array, None for missing values.
+    # None when the column holds values that are not plain strings or numbers.
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        # Dictionary encoded: each category is encoded once and taken by code,
+        # code -1 (missing) reads the trailing None
+        dictionary = _encode_values(pd.Series(dtype.categories))
+        if dictionary is None:
+            return None
+        return np.append(dictionary, None)[values.cat.codes.to_numpy()]
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, "tz", None) is not None:
+            values = values.dt.tz_localize(None)
+        times = values.to_numpy(dtype="datetime64[ns]")
+        # Same text as the isoformat st_aggrid sends, e.g. 2024-01-31T00:00:00
+        encoded = np.datetime_as_string(times, unit="s").astype(object)
+        encoded[np.isnat(times)] = None
+        return encoded
+    if pd.api.types.is_float_dtype(dtype):
+        numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        encoded = numbers.astype(object)
+        encoded[~np.isfinite(numbers)] = None
+        return encoded
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return values.to_numpy(dtype=object, na_value=None)
+    if pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+        encoded = values.to_numpy(dtype=object, copy=True)
+        encoded[values.isna().to_numpy()] = None
+        return encoded
+    return None
+
+
+def encode_columns(df: pd.DataFrame) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Encode a frame for the grid column by column.
+    Return:
+        1. dict of column -> object array of JSON values, None when a column
+           cannot be encoded (e.g. objects other than strings)
+    """
+    columns = {}
+    for column in df.columns:
+        encoded = _encode_values(df[column])
+        if encoded is None:
+            return None
+        columns[str(column)] = encoded
+    return columns
+
+
+class _ColumnsCache:
+    # Encoded columns of the frames given to the grids. Frames are held
+    # weakly, the columns are dropped with their frame.
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, df: pd.DataFrame) -> Optional[Dict[str, np.ndarray]]:
+        key = id(df)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is df:
+                self._entries.move_to_end(key)
+                return entry[1]
+        columns = encode_columns(df)
+        with self._lock:
+            self._entries[key] = (weakref.ref(df), columns)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return columns
+
+
+_columns_cache = _ColumnsCache(GRID_ROW_DATA_CACHE_ENTRIES)
+
+
+def row_data(df: pd.DataFrame, cache: bool = True) -> Optional[List[Dict]]:
+    """
+    Build the rowData of a grid from the encoded columns of df, in place of
+    the copy, per cell datetime conversion and JSON round trip st_aggrid
+    does on every run.
+    Input:
+        1. df: frame to show, must not be modified once given
+        2. cache: keep the encoded columns of df for the next runs and
+           sessions, for frames that are shown again (not for pages)
+    Return:
+        1. list of row dicts, ided by position in "__pandas_index" as
+           st_aggrid does. None when df cannot be encoded, the caller falls
+           back to st_aggrid.
+    """
+    columns = _columns_cache.get(df) if cache else encode_columns(df)
+    if columns is None:
+        return None
+    names = list(columns) + ["__pandas_index"]
+    ids = np.arange(len(df)).astype(str).astype(object)
+    return [dict(zip(names, row)) for row in zip(*columns.values(), ids)]
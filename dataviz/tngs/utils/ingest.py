@@ -0,0 +1,195 @@
+import io
+import time
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+from utils.constants import INGEST_CHUNK_SIZE, WORKBOOK_SHEETS
+from utils.schema import CoercionReport, compact_frames
+
+# progress(sheet_name, rows_done, total_rows, elapsed_seconds)
+ProgressCallback = Callable[[str, int, Optional[int], float], None]
+
+
+def _cell_to_str(value):
+    # Same as pandas' openpyxl reader: integral floats are shown without ".0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return value
+
+
+def _raw_dtype(dtype: Dict[str, str]) -> Dict[str, str]:
+    # Text columns are read as strings, every other column keeps its raw cell
+    # values for coerce_frame, so a malformed cell does not abort the read
+    return {col: "string" if t == "string" else "object" for col, t in dtype.items()}
+
+
+def _to_typed_column(values: List, dtype: Optional[str]):
+    if dtype == "string":
+        return pd.array([_cell_to_str(v) for v in values], dtype="string")
+    return pd.array(values, dtype=object)
+
+
+def read_sheet_chunked(
+    worksheet,
+    dtype: Dict[str, str],
+    columns: List[str],
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    max_memory_mb: Optional[float] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> pd.DataFrame:
+    """
+    Stream a read-only openpyxl worksheet into a DataFrame.
+    Rows are converted straight into column buffers, chunk_size rows at a
+    time, and only the requested columns are kept.
+    Input:
+        1. worksheet: openpyxl read-only worksheet, header in the first row
+        2. dtype: column dtype mapping, "string" columns are read as strings
+           and the others as raw cell values
+        3. columns: columns to keep, e.g. ETIOLOGY_COLUMNS
+        4. chunk_size: number of rows converted at a time
+        5. max_memory_mb: ceiling for the typed buffers (counted twice, as
+           the final concatenation copies them), None for no limit
+        6. progress: called after every chunk
+    Return:
+        1. pd.DataFrame with the requested columns in the requested order
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None) or ()
+    positions = {name: i for i, name in enumerate(header) if name is not None}
+    missing_columns = [col for col in columns if col not in positions]
+    if missing_columns:
+        raise ValueError(
+            f"Missing columns in sheet '{worksheet.title}': {missing_columns}"
+        )
+    indexes = [positions[col] for col in columns]
+
+    total_rows = worksheet.max_row - 1 if worksheet.max_row else None
+    max_bytes = max_memory_mb * 2**20 if max_memory_mb else None
+    chunks = []
+    held_bytes = 0
+    rows_done = 0
+    start = time.perf_counter()
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        rows_done += len(chunk)
+        # Keep projected values only, and skip blank rows
+        chunk = [
+            values
+            for values in (
+                [row[i] if i < len(row) else None for i in indexes] for row in chunk
+            )
+            if any(v is not None for v in values)
+        ]
+        if chunk:
+            buffers = zip(*chunk)
+            df_chunk = pd.DataFrame(
+                {
+                    col: _to_typed_column(list(values), dtype.get(col))
+                    for col, values in zip(columns, buffers)
+                }
+            )
+            held_bytes += df_chunk.memory_usage(deep=True).sum()
+            if max_bytes is not None and 2 * held_bytes > max_bytes:
+                raise MemoryError(
+                    f"Sheet '{worksheet.title}' exceeds the memory ceiling of "
+                    f"{max_memory_mb} MB after {rows_done} rows"
+                )
+            chunks.append(df_chunk)
+
+        if progress is not None:
+            progress(
+                worksheet.title, rows_done, total_rows, time.perf_counter() - start
+            )
+
+    if not chunks:
+        return pd.DataFrame(
+            {col: _to_typed_column([], dtype.get(col)) for col in columns}
+        )
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_workbook_streaming(
+    file,
+    sheets: Dict,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    max_memory_mb: Optional[float] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Stream several sheets out of a workbook opened once in read-only mode.
+    Input:
+        1. file: path or file-like xlsx
+        2. sheets: sheet name -> (dtype, columns), e.g. WORKBOOK_SHEETS
+        3. chunk_size, max_memory_mb, progress: see read_sheet_chunked
+    Return:
+        1. dict of sheet name -> pd.DataFrame
+    """
+    workbook = openpyxl.load_workbook(
+        file, read_only=True, data_only=True, keep_links=False
+    )
+    try:
+        return {
+            sheet_name: read_sheet_chunked(
+                workbook[sheet_name],
+                _raw_dtype(dtype),
+                columns,
+                chunk_size=chunk_size,
+                max_memory_mb=max_memory_mb,
+                progress=progress,
+            )
+            for sheet_name, (dtype, columns) in sheets.items()
+        }
+    finally:
+        workbook.close()
+
+
+def read_workbook_pandas(file, sheets: Dict) -> Dict[str, pd.DataFrame]:
+    """
+    Read several sheets with pd.read_excel out of a workbook opened once.
+    """
+    frames = {}
+    # The openpyxl engine opens the workbook once in read-only mode and
+    # reads every requested sheet from the same zip handle
+    with pd.ExcelFile(file, engine="openpyxl") as xls:
+        for sheet_name, (dtype, columns) in sheets.items():
+            df = xls.parse(sheet_name, dtype=_raw_dtype(dtype))
+            frames[sheet_name] = df.loc[:, columns]
+    return frames
+
+
+def parse_workbook(
+    file,
+    streaming: bool,
+    max_memory_mb: Optional[float] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, CoercionReport]]:
+    """
+    Parse the WORKBOOK_SHEETS of an xlsx into typed and compacted frames.
+    Input:
+        1. file: path or file-like xlsx
+        2. streaming: use read_workbook_streaming instead of pd.read_excel
+        3. max_memory_mb, progress: see read_sheet_chunked (streaming only)
+    Return:
+        1. dict of sheet name -> pd.DataFrame coerced to WORKBOOK_SCHEMAS
+        2. dict of sheet name -> CoercionReport of the cells that did not parse
+    """
+    if streaming:
+        frames = read_workbook_streaming(
+            file, WORKBOOK_SHEETS, max_memory_mb=max_memory_mb, progress=progress
+        )
+    else:
+        frames = read_workbook_pandas(file, WORKBOOK_SHEETS)
+    return compact_frames(frames)
+
+
+def parse_workbook_bytes(
+    data: bytes, streaming: bool, max_memory_mb: Optional[float] = None
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, CoercionReport]]:
+    """
+    Process pool entry point of parse_workbook, the workbook is sent as bytes.
+    """
+    return parse_workbook(io.BytesIO(data), streaming, max_memory_mb=max_memory_mb)
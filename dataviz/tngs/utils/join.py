@@ -0,0 +1,130 @@
+from typing import NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class JoinIndex(NamedTuple):
+    # One entry per row of the sample-left-joined frame
+    left: np.ndarray  # sample row positions
+    right: np.ndarray  # child row positions, -1 for samples without child rows
+
+
+def sample_keys(
+    df_sample: pd.DataFrame, df_child: pd.DataFrame, on: str = "sample_name"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Assign integer sample keys to the rows of a sample frame and a child frame.
+    Return:
+        1. np.ndarray, key of every sample row
+        2. np.ndarray, key of every child row, -1 if its sample is unknown
+        Missing sample names share one key, as df.merge matches missing keys
+        with each other.
+    """
+    keys, uniques = pd.factorize(df_sample[on])
+    child_keys = pd.Index(uniques).get_indexer(df_child[on])
+    # factorize and get_indexer give -1 to missing names
+    na_key = len(uniques)
+    keys[df_sample[on].isna().to_numpy()] = na_key
+    child_keys[df_child[on].isna().to_numpy()] = na_key
+    return keys.astype(np.int32), child_keys.astype(np.int32)
+
+
+def build_join_index(sample_key: np.ndarray, child_key: np.ndarray) -> JoinIndex:
+    """
+    Build the row offsets of a sample-left-join-child merge from integer keys.
+    Rows come out in the same order as
+    `df_sample.merge(df_child, on=..., how="left")`.
+    """
+    n_keys = int(max(sample_key.max(initial=-1), child_key.max(initial=-1))) + 1
+    matched = child_key >= 0
+    # Child rows grouped by key, in their original order within a key
+    order = np.flatnonzero(matched)[np.argsort(child_key[matched], kind="stable")]
+    counts = np.bincount(child_key[matched], minlength=n_keys)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    # Samples with key -1 get no child rows, rather than the last key's
+    sample_counts = np.where(sample_key >= 0, counts[sample_key], 0)
+    rows_per_sample = np.maximum(sample_counts, 1)
+    left = np.repeat(np.arange(len(sample_key)), rows_per_sample)
+    # Offset of every output row within its sample
+    offsets = np.arange(len(left)) - np.repeat(
+        np.cumsum(rows_per_sample) - rows_per_sample, rows_per_sample
+    )
+    has_child = np.repeat(sample_counts > 0, rows_per_sample)
+    right = np.full(len(left), -1, dtype=np.int64)
+    right[has_child] = order[
+        np.repeat(starts[sample_key], rows_per_sample)[has_child] + offsets[has_child]
+    ]
+    return JoinIndex(left=left, right=right)
+
+
+def take_rows(df: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+    """
+    Gather rows of df by position, -1 positions give missing values.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        values = (
+            values.array
+            if pd.api.types.is_extension_array_dtype(values.dtype)
+            else values.to_numpy()
+        )
+        columns[col] = pd.api.extensions.take(values, positions, allow_fill=True)
+    return pd.DataFrame(columns)
+
+
+def merge_by_index(
+    df_sample: pd.DataFrame,
+    df_child: pd.DataFrame,
+    join_index: JoinIndex,
+    on: str = "sample_name",
+) -> pd.DataFrame:
+    """
+    Left join df_child onto df_sample by position with a prebuilt JoinIndex,
+    no string hashing involved.
+    Return:
+        1. pd.DataFrame, same rows and columns as
+           `df_sample.merge(df_child, on=on, how="left")`. Columns other than
+           on must not be in both frames, they are not suffixed as df.merge
+           does.
+    """
+    overlap = df_sample.columns.intersection(df_child.columns).difference([on])
+    if len(overlap):
+        raise ValueError(
+            f"Columns in both the sample and the child frame: {list(overlap)}"
+        )
+    df_left = take_rows(df_sample, join_index.left)
+    df_right = take_rows(df_child.drop(columns=on), join_index.right)
+    return pd.concat([df_left, df_right], axis=1)
+
+
+def test():
+    df_sample = pd.DataFrame({"sample_name": ["a", None, "b", np.nan, "c"]})
+    df_sample["x"] = range(len(df_sample))
+    df_child = pd.DataFrame({"sample_name": ["b", None, "a", "z", np.nan, "b"]})
+    df_child["y"] = range(len(df_child))
+    for dtype in [object, "string[pyarrow]", "category"]:
+        left = df_sample.astype({"sample_name": dtype})
+        right = df_child.astype({"sample_name": dtype})
+        join_index = build_join_index(*sample_keys(left, right))
+        merged = merge_by_index(left, right, join_index)
+        expected = left.merge(right, on="sample_name", how="left")
+        pd.testing.assert_frame_equal(
+            merged, expected, check_dtype=False, check_categorical=False
+        )
+    # Unmatched keys give no child rows
+    join_index = build_join_index(np.array([-1, 0]), np.array([0, 0]))
+    assert join_index.right.tolist() == [-1, 0, 1]
+    try:
+        merge_by_index(df_sample, df_sample, join_index)
+    except ValueError as e:
+        print(e)
+    else:
+        raise AssertionError("overlapping columns were not rejected")
+    print("merge_by_index matches df.merge")
+
+
+if __name__ == "__main__":
+    test()
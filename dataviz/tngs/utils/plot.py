@@ -1,104 +1,138 @@
+import io
 import os
+from typing import Dict, List, NamedTuple, Optional
 
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.graph_objs import Figure
 from plotly.subplots import make_subplots
+from scipy.cluster.hierarchy import leaves_list, linkage
+from utils.constants import HEATMAP_DECIMALS, HEATMAP_TOP_K, HISTOGRAM_MAX_INTEGER_BINS
+from utils.cube import CountCube, build_cube, count_matrix, rollup
+from utils.schema import coerce_frame
+from utils.text import build_token_index, token_frequencies
 from wordcloud import WordCloud
 
 
-def sample_etiology_heatmap(df: pd.DataFrame, mode: str = "count") -> Figure:
+class HeatmapMatrix(NamedTuple):
+    # Sorted labels of the detected pathos and of the months with detections
+    pathos: pd.Index
+    months: pd.Index
+    # Detections, pathos x months
+    counts: np.ndarray
+    # Distinct samples per month, all months with samples
+    monthly_samples: pd.Series
+
+
+def sample_etiology_matrix(
+    df: Optional[pd.DataFrame] = None,
+    cube: Optional[CountCube] = None,
+    sample_cube: Optional[CountCube] = None,
+    pathos: Optional[List[str]] = None,
+) -> HeatmapMatrix:
     """
-    Make heatmap to show the detected patho in a period of time.
+    Count the detections per month and patho, and the samples per month,
+    once for both heatmap modes.
     Input:
         1. df: etiology and sample merged dataframe with necessary cols:
             1. sample_name (string)
             2. collect_time (datetime64)
-            3. patho_name (string)
-        2. mode: str, either "count" for number of detections or "frequency" for detection frequency.
+            3. patho_name (category)
+           Not needed when the cubes are given.
+        2. cube: CountCube of the merged rows over "day" and "patho_name"
+        3. sample_cube: CountCube of the distinct samples over "day", the
+           frequency denominators
+        4. pathos: only count these pathos of cube
     Return:
-        1. plotly Figure
+        1. HeatmapMatrix
     """
 
     COLUMN_DTYPE = {
         "sample_name": "string",
-        "patho_name": "string",
+        "patho_name": "category",
         "collect_time": "datetime64[ns]",
     }
 
-    # Check necessary columns
-    missing_columns = [col for col in COLUMN_DTYPE.keys() if col not in df.columns]
-    if missing_columns:
-        raise ValueError(f"Missing columns in DataFrame: {missing_columns}")
-
-    # Convert data type
-    for col, dtype in COLUMN_DTYPE.items():
-        try:
-            df.loc[:, col] = df[col].astype(dtype)
-        except Exception as e:
-            raise ValueError(f"Cannot convert column '{col}' to type '{dtype}': {e}")
-
-    # Extract cols
-    df_sub = df[list(COLUMN_DTYPE.keys())].copy()
-
-    df_sub["month"] = (
-        df_sub["collect_time"].astype("datetime64[ns]").dt.to_period("M").astype(str)
-    )
-    # Aggregate data to get counts
-    heatmap_data = (
-        df_sub.groupby(["month", "patho_name"]).size().reset_index(name="count")
+    if cube is None or sample_cube is None:
+        # Check necessary columns
+        missing_columns = [col for col in COLUMN_DTYPE.keys() if col not in df.columns]
+        if missing_columns:
+            raise ValueError(f"Missing columns in DataFrame: {missing_columns}")
+
+        # Extract cols, typed columns (as loaded) are not cast again and cells
+        # that do not parse are left missing
+        df_sub, _ = coerce_frame(df[list(COLUMN_DTYPE.keys())], COLUMN_DTYPE)
+        cube = build_cube(df_sub, ["day", "patho_name"])
+        sample_cube = build_cube(df_sub, ["day"], distinct="sample_name")
+
+    # Aggregate data to get counts, from the cube cells instead of the rows
+    patho_labels, months, counts = count_matrix(
+        cube,
+        "patho_name",
+        "month",
+        where=None if pathos is None else {"patho_name": pathos},
     )
 
     # Get monthly sample count
-    monthly_samples = df_sub.groupby("month")["sample_name"].nunique()
+    monthly_samples = rollup(sample_cube, ["month"]).set_index("month")["count"]
     monthly_samples.name = "total_samples"
-    print(monthly_samples)
-    # monthly_samples = df_sub.groupby("month")["sample_name"].nunique().reset_index(name="total_samples")
-
-    # Always store a heatmap_data_count for bar plot
-    heatmap_data_count = heatmap_data
-    heatmap_data_count["value"] = heatmap_data_count["count"]
-
+    return HeatmapMatrix(patho_labels, months, counts, monthly_samples)
+
+
+def _cluster_order(values: np.ndarray) -> np.ndarray:
+    # Rows with similar monthly profiles next to each other
+    totals = values.sum(axis=1, keepdims=True)
+    profiles = np.divide(values, totals, out=np.zeros_like(values), where=totals > 0)
+    return leaves_list(linkage(profiles, method="average", metric="euclidean"))
+
+
+def _heatmap_figure(
+    matrix: HeatmapMatrix,
+    mode: str,
+    top_k: Optional[int] = HEATMAP_TOP_K,
+    cluster: bool = False,
+) -> Figure:
+    counts = matrix.counts.astype(np.float64)
+    pathos = matrix.pathos.astype(str)
+    if top_k is not None and len(pathos) > top_k:
+        # Top-K most detected pathos, the others summed into one row
+        ranked = np.argsort(-counts.sum(axis=1), kind="stable")
+        keep, other = np.sort(ranked[:top_k]), ranked[top_k:]
+        counts = np.vstack([counts[keep], counts[other].sum(axis=0)])
+        pathos = pathos[keep].append(pd.Index([f"Other ({len(other)} pathos)"]))
     if mode == "frequency":
-        # Merge heatmap data with monthly sample counts to calculate frequencies
-        heatmap_data = pd.merge(heatmap_data, monthly_samples, on="month")
-        print(heatmap_data)
-        heatmap_data["value"] = heatmap_data["count"] / heatmap_data["total_samples"]
+        # Detections over the samples of the month
+        values = counts / matrix.monthly_samples.reindex(matrix.months).to_numpy()
         colorbar_title = "Frequency"
-        # Pivot the data for heatmap
-        heatmap_data_pivot = heatmap_data.pivot(
-            index="patho_name", columns="month", values="value"
-        ).fillna(0)
-        heatmap_data_pivot = heatmap_data_pivot.loc[
-            heatmap_data_pivot.sum(axis=1).sort_values(ascending=True).index
-        ]
-        heatmap_data_count_pivot = heatmap_data_count.pivot(
-            index="patho_name", columns="month", values="value"
-        ).fillna(0)
-        heatmap_data_count_pivot = heatmap_data_count_pivot.loc[
-            heatmap_data_pivot.sum(axis=1).sort_values(ascending=True).index
-        ]
-        total_counts = heatmap_data_count_pivot.sum(axis=1)
-        monthly_totals = heatmap_data_count_pivot.sum(axis=0)
     elif mode == "count":
-        heatmap_data["value"] = heatmap_data["count"]
+        values = counts
         colorbar_title = "Count"
-        # Pivot the data for heatmap
-        heatmap_data_pivot = heatmap_data.pivot(
-            index="patho_name", columns="month", values="value"
-        ).fillna(0)
-        heatmap_data_pivot = heatmap_data_pivot.loc[
-            heatmap_data_pivot.sum(axis=1).sort_values(ascending=True).index
-        ]
-        total_counts = heatmap_data_pivot.sum(axis=1)
-        monthly_totals = heatmap_data_pivot.sum(axis=0)
     else:
         raise ValueError("Invalid mode. Choose either 'count' or 'frequency'.")
+    if cluster and len(values) > 2:
+        order = _cluster_order(values)
+    else:
+        # Least detected patho first
+        order = np.argsort(values.sum(axis=1), kind="stable")
+    # Integral counts and rounded frequencies keep the figure JSON short
+    heatmap_values = (
+        values[order].astype(np.int64)
+        if mode == "count"
+        else values[order].round(HEATMAP_DECIMALS)
+    )
+    heatmap_pathos = pathos[order]
+    total_counts = pd.Series(
+        counts[order].sum(axis=1).astype(np.int64), index=heatmap_pathos
+    )
+    monthly_totals = pd.Series(
+        matrix.counts.sum(axis=0).astype(np.int64), index=matrix.months
+    )
+    monthly_samples = matrix.monthly_samples
 
     # Plot
-    dynamic_height = 20 * len(heatmap_data_pivot.index)
+    dynamic_height = 20 * len(heatmap_pathos)
 
     fig = make_subplots(
         rows=2,
@@ -131,9 +165,9 @@ def sample_etiology_heatmap(df: pd.DataFrame, mode: str = "count") -> Figure:
 
     # 添加热图
     heatmap = go.Heatmap(
-        z=heatmap_data_pivot.values,
-        x=heatmap_data_pivot.columns.astype(str),
-        y=heatmap_data_pivot.index,
+        z=heatmap_values,
+        x=matrix.months.astype(str),
+        y=heatmap_pathos,
         colorscale="Blues",
         colorbar=dict(title="Count"),
         name=f"Detected {colorbar_title}",
@@ -159,9 +193,122 @@ def sample_etiology_heatmap(df: pd.DataFrame, mode: str = "count") -> Figure:
     return fig
 
 
+def sample_etiology_heatmaps(
+    matrix: HeatmapMatrix, top_k: Optional[int] = HEATMAP_TOP_K, cluster: bool = False
+) -> Dict[str, Figure]:
+    """
+    Make the count and the frequency heatmaps from one HeatmapMatrix.
+    Input:
+        1. matrix: HeatmapMatrix
+        2. top_k: number of most detected pathos drawn as their own row, the
+           others are summed into one "Other" row. None to draw every patho.
+        3. cluster: order the rows by hierarchical clustering of their
+           monthly profiles instead of by total
+    Return:
+        1. dict of mode ("count", "frequency") -> plotly Figure
+    """
+    return {
+        mode: plot_etiology_heatmap(matrix, mode, top_k=top_k, cluster=cluster)
+        for mode in ("count", "frequency")
+    }
+
+
+def plot_etiology_heatmap(
+    matrix: HeatmapMatrix,
+    mode: str = "count",
+    top_k: Optional[int] = HEATMAP_TOP_K,
+    cluster: bool = False,
+) -> Figure:
+    """
+    Make one heatmap of a HeatmapMatrix, e.g. to compute the two modes
+    concurrently. See sample_etiology_heatmaps.
+    """
+    if mode not in ("count", "frequency"):
+        raise ValueError("Invalid mode. Choose either 'count' or 'frequency'.")
+    return _heatmap_figure(matrix, mode, top_k=top_k, cluster=cluster)
+
+
+def plot_pathogen_detail(matrix: HeatmapMatrix, patho: str) -> Figure:
+    """
+    Make the monthly detections and frequency of one patho of a HeatmapMatrix,
+    e.g. one grouped into the "Other" heatmap row.
+    """
+    counts = matrix.counts[matrix.pathos.astype(str).get_loc(patho)]
+    samples = matrix.monthly_samples.reindex(matrix.months).to_numpy()
+    months = matrix.months.astype(str)
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_trace(go.Bar(x=months, y=counts, name="Count"), secondary_y=False)
+    fig.add_trace(
+        go.Scatter(
+            x=months,
+            y=(counts / samples).round(HEATMAP_DECIMALS),
+            name="Frequency",
+            mode="lines+markers",
+        ),
+        secondary_y=True,
+    )
+    fig.update_layout(title=f"Monthly detections of {patho}")
+    return fig
+
+
+def sample_etiology_heatmap(
+    df: Optional[pd.DataFrame] = None,
+    mode: str = "count",
+    cube: Optional[CountCube] = None,
+    sample_cube: Optional[CountCube] = None,
+    pathos: Optional[List[str]] = None,
+    top_k: Optional[int] = HEATMAP_TOP_K,
+) -> Figure:
+    """
+    Make heatmap to show the detected patho in a period of time.
+    Input:
+        1. df, cube, sample_cube, pathos: see sample_etiology_matrix
+        2. mode: str, either "count" for number of detections or "frequency" for detection frequency.
+        3. top_k: see sample_etiology_heatmaps
+    Return:
+        1. plotly Figure
+    """
+    if mode not in ("count", "frequency"):
+        raise ValueError("Invalid mode. Choose either 'count' or 'frequency'.")
+    matrix = sample_etiology_matrix(
+        df, cube=cube, sample_cube=sample_cube, pathos=pathos
+    )
+    return _heatmap_figure(matrix, mode, top_k=top_k)
+
+
+def plot_period_counts(
+    cube: CountCube,
+    period: str,
+    group: str,
+    title: str,
+    labels: Optional[dict] = None,
+) -> Figure:
+    """
+    Make a line chart of the number of rows per period and group.
+    Input:
+        1. cube: CountCube with "day" and group dims
+        2. period: a period of CUBE_PERIODS, e.g. "week"
+        3. group: dim of the lines, e.g. "age_group"
+        4. title, labels: see px.line
+    Return:
+        1. plotly Figure
+    """
+    df_counts = rollup(cube, [period, group])
+    fig = px.line(
+        df_counts, x=period, y="count", color=group, title=title, labels=labels
+    )
+    # Week and quarter labels are categories, keep them in time order even
+    # when the first line misses some periods
+    fig.update_xaxes(categoryorder="category ascending")
+    if period == "month":
+        fig.update_layout(xaxis=dict(tickformat="%Y-%m"))
+    return fig
+
+
 def plot_pie_chart(df, column_name):
     """
     Function to plot a pie chart for a specific column in the DataFrame.
+    The values are counted here, only one count per slice is sent.
 
     Parameters:
     df (pandas.DataFrame): The DataFrame containing the data.
@@ -170,52 +317,96 @@ def plot_pie_chart(df, column_name):
     Returns:
     A Plotly pie chart.
     """
-    fig = px.pie(df, names=column_name, title=f"Distribution of {column_name}")
+    counts = df[column_name].value_counts(sort=False)
+    counts = counts[counts > 0].rename("count").reset_index()
+    fig = px.pie(
+        counts,
+        names=column_name,
+        values="count",
+        title=f"Distribution of {column_name}",
+    )
     return fig
 
 
+def _histogram_edges(values: np.ndarray, bins=None) -> np.ndarray:
+    if bins is None and len(values) and np.all(values == np.round(values)):
+        low, high = values.min(), values.max()
+        if high - low <= HISTOGRAM_MAX_INTEGER_BINS:
+            # One bin per integer, e.g. number of detected pathos
+            return np.arange(low - 0.5, high + 1.5)
+    return np.histogram_bin_edges(values, bins="auto" if bins is None else bins)
+
+
 def plot_histogram(df, column_name, bins=None):
     """
     Function to plot a histogram for a specific column in the DataFrame.
+    The bins are counted here with numpy, only one bar per bin is sent.
 
     Parameters:
     df (pandas.DataFrame): The DataFrame containing the data.
     column_name (str): The name of the column to plot.
-    bins (int): The number of bins for the histogram. Default is None.
+    bins (int): The number of bins for the histogram. Default is None, one
+        bin per value for small integer ranges, numpy's "auto" otherwise.
 
     Returns:
     A Plotly histogram.
     """
-    fig = px.histogram(
-        df, x=column_name, nbins=bins, title=f"Histogram of {column_name}"
+    values = df[column_name].dropna().to_numpy(dtype=np.float64)
+    edges = _histogram_edges(values, bins)
+    counts, edges = np.histogram(values, bins=edges)
+    fig = go.Figure(
+        go.Bar(
+            x=(edges[:-1] + edges[1:]) / 2,
+            y=counts,
+            width=np.diff(edges),
+            name=column_name,
+        )
+    )
+    fig.update_layout(
+        title=f"Histogram of {column_name}",
+        xaxis_title=column_name,
+        yaxis_title="count",
+        bargap=0,
     )
     return fig
 
 
-def plot_wordcloud(df, column_name, font_path="./dataviz/tngs/utils/simhei.ttf"):
+def plot_wordcloud_frequencies(
+    frequencies: Dict[str, int], font_path="./dataviz/tngs/utils/simhei.ttf"
+) -> bytes:
     """
-    Function to plot a word cloud for a specific column in the DataFrame.
+    Render a word cloud of precomputed word frequencies.
 
     Parameters:
-    df (pandas.DataFrame): The DataFrame containing the data.
-    column_name (str): The name of the column to plot.
+    frequencies (dict): word -> count, e.g. from utils.text.token_frequencies.
+    font_path (str): font with the Chinese glyphs.
 
     Returns:
-    A matplotlib plot of the word cloud.
+    PNG bytes of the word cloud.
     """
     if not os.path.isfile(font_path):
         raise FileNotFoundError(f"Font file not found: {font_path}")
+    if not frequencies:
+        raise ValueError("No words to plot")
 
-    # Concatenate all text in the column into a single string
-    text = " ".join(df[column_name].astype(str).values)
-
-    # Generate the word cloud
     wordcloud = WordCloud(
         width=800, height=400, background_color="white", font_path=font_path
-    ).generate(text)
+    ).generate_from_frequencies(frequencies)
+    buffer = io.BytesIO()
+    wordcloud.to_image().save(buffer, format="PNG")
+    return buffer.getvalue()
 
-    # Plot the word cloud
-    fig, ax = plt.subplots(figsize=(10, 5))
-    ax.imshow(wordcloud, interpolation="bilinear")
-    ax.axis("off")
-    return fig
+
+def plot_wordcloud(df, column_name, font_path="./dataviz/tngs/utils/simhei.ttf"):
+    """
+    Function to plot a word cloud for a specific column in the DataFrame.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame containing the data.
+    column_name (str): The name of the column to plot.
+
+    Returns:
+    PNG bytes of the word cloud.
+    """
+    frequencies = token_frequencies(build_token_index(df[column_name]))
+    return plot_wordcloud_frequencies(frequencies, font_path=font_path)
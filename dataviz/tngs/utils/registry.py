@@ -0,0 +1,157 @@
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("value", "nbytes", "refs", "derived")
+
+    def __init__(self, value, nbytes: int):
+        self.value = value
+        self.nbytes = nbytes
+        self.refs = 0
+        # Values computed from the dataset (e.g. merged frames), shared too
+        self.derived: Dict[Hashable, Any] = {}
+
+
+class DatasetHandle:
+    """
+    Read-only handle of a registry dataset held by one session. The dataset
+    stays in memory as long as a handle of it is alive; dropping the handle
+    (e.g. the session ends or holds another dataset) releases it.
+    """
+
+    def __init__(self, registry: "DatasetRegistry", key: str, value):
+        self.key = key
+        self.value = value
+        weakref.finalize(self, registry._release, key)
+
+
+class DatasetRegistry:
+    """
+    Process-wide registry of immutable parsed datasets, keyed by dataset key
+    (content digest + schema), so every session opening the same workbook
+    shares one copy.
+    Datasets held by a session are never evicted. The others are evicted
+    least recently used first once the registry exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: Optional[int], sizeof: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key: str):
+        """
+        Get a dataset, None if it is not in the registry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def put(self, key: str, value):
+        """
+        Add a dataset, unless another session added the same key first.
+        Return:
+            1. the registered value, use it instead of value
+        """
+        nbytes = self._sizeof(value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(value, nbytes)
+                self._nbytes += nbytes
+            self._entries.move_to_end(key)
+            self._evict()
+            return entry.value
+
+    def acquire(self, key: str, load: Callable[[], Any]) -> DatasetHandle:
+        """
+        Get a handle of a dataset, loaded with load() if it is not in the
+        registry.
+        """
+        value = self.get(key)
+        if value is None:
+            value = load()
+        nbytes = self._sizeof(value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(value, nbytes)
+                self._nbytes += nbytes
+            entry.refs += 1
+            self._entries.move_to_end(key)
+            self._evict()
+            return DatasetHandle(self, key, entry.value)
+
+    def derive(self, key: str, name: Hashable, build: Callable[[], Any]):
+        """
+        Get a value computed from a registered dataset, built once and shared.
+        The dataset must be in the registry (i.e. held by the caller).
+        """
+        with self._lock:
+            entry = self._entries[key]
+            if name in entry.derived:
+                return entry.derived[name]
+        value = build()
+        nbytes = self._sizeof(value)
+        with self._lock:
+            if name not in entry.derived:
+                entry.derived[name] = value
+                entry.nbytes += nbytes
+                if self._entries.get(key) is entry:
+                    self._nbytes += nbytes
+                self._evict()
+            return entry.derived[name]
+
+    def derived(self, key: str) -> Dict[Hashable, Any]:
+        """
+        Get the values derived from a dataset so far, empty if the dataset is
+        not in the registry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return {} if entry is None else dict(entry.derived)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of datasets, their bytes and the number of handles.
+        """
+        with self._lock:
+            return {
+                "datasets": len(self._entries),
+                "bytes": self._nbytes,
+                "handles": sum(entry.refs for entry in self._entries.values()),
+            }
+
+    def _release(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs -= 1
+                self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        if self.max_bytes is None:
+            return
+        for key in list(self._entries):
+            if self._nbytes <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.refs > 0:
+                continue
+            del self._entries[key]
+            self._nbytes -= entry.nbytes
+            logger.info(
+                "Dataset registry evicted %s (%.1f MB)", key, entry.nbytes / 2**20
+            )
@@ -0,0 +1,225 @@
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from utils.constants import (
+    CATEGORY_COLUMNS,
+    DATETIME_FORMATS,
+    DRUGRESIS_DTYPE,
+    ETIOLOGY_DTYPE,
+    SAMPLE_DTYPE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def compact_dtype(dtype: Dict[str, str]) -> Dict[str, str]:
+    """
+    Map the "string" columns of a read dtype to compact in-memory dtypes:
+    categorical codes for CATEGORY_COLUMNS, Arrow-backed strings otherwise.
+    Integer columns become nullable, so a malformed cell is a missing value.
+    Other dtypes are kept as is.
+    """
+
+    def _compact(col, t):
+        if t == "string":
+            return "category" if col in CATEGORY_COLUMNS else "string[pyarrow]"
+        if t == "int64":
+            return "Int64"
+        return t
+
+    return {col: _compact(col, t) for col, t in dtype.items()}
+
+
+SAMPLE_SCHEMA = compact_dtype(SAMPLE_DTYPE)
+ETIOLOGY_SCHEMA = compact_dtype(ETIOLOGY_DTYPE)
+DRUGRESIS_SCHEMA = compact_dtype(DRUGRESIS_DTYPE)
+
+WORKBOOK_SCHEMAS = {
+    "sample": SAMPLE_SCHEMA,
+    "etiology": ETIOLOGY_SCHEMA,
+    "drugresis": DRUGRESIS_SCHEMA,
+}
+
+# Sample-left-join frames of the etiology and drugresis sheets
+ETIOLOGY_MERGE_SCHEMA = {**SAMPLE_SCHEMA, **ETIOLOGY_SCHEMA}
+DRUGRESIS_MERGE_SCHEMA = {**SAMPLE_SCHEMA, **DRUGRESIS_SCHEMA}
+
+
+# Column -> positions of the rows whose cell could not be coerced
+CoercionReport = Dict[str, np.ndarray]
+
+
+def _coerce_datetime(values: pd.Series, dtype: str) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.astype(dtype)
+    result = pd.Series(pd.NaT, index=values.index, dtype=dtype)
+    pending = values.notna()
+    for fmt in DATETIME_FORMATS:
+        if not pending.any():
+            break
+        result[pending] = pd.to_datetime(values[pending], format=fmt, errors="coerce")
+        pending &= result.isna()
+    return result
+
+
+def _coerce_numeric(values: pd.Series, dtype: str) -> pd.Series:
+    numbers = pd.to_numeric(values, errors="coerce")
+    if pd.api.types.is_integer_dtype(pd.api.types.pandas_dtype(dtype)):
+        # 1.5 is not a valid count
+        numbers = numbers.where(numbers % 1 == 0)
+    return numbers.astype(dtype)
+
+
+def _coerce_column(values: pd.Series, dtype: str) -> pd.Series:
+    if dtype.startswith("datetime64"):
+        return _coerce_datetime(values, dtype)
+    if pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(dtype)):
+        return _coerce_numeric(values, dtype)
+    if dtype == "category" and isinstance(values.dtype, pd.StringDtype):
+        # Plain object categories, as read back from the Parquet store
+        return values.astype(object).astype(dtype)
+    return values.astype(dtype)
+
+
+def coerce_frame(
+    df: pd.DataFrame, schema: Dict[str, str]
+) -> Tuple[pd.DataFrame, CoercionReport]:
+    """
+    Cast the columns of df present in schema, skipping those already typed.
+    Datetimes are parsed with DATETIME_FORMATS and numbers with
+    pd.to_numeric, one vectorised pass per column. Cells that do not parse
+    become missing values instead of raising.
+    Return:
+        1. pd.DataFrame, the coerced frame (df itself if nothing to cast)
+        2. CoercionReport of the cells that were set missing
+    """
+    casts = {
+        col: dtype
+        for col, dtype in schema.items()
+        if col in df.columns and df[col].dtype != dtype
+    }
+    if not casts:
+        return df, {}
+
+    df = df.copy(deep=False)
+    report = {}
+    for col, dtype in casts.items():
+        values = df[col]
+        coerced = _coerce_column(values, dtype)
+        bad_rows = np.flatnonzero(values.notna().to_numpy() & coerced.isna().to_numpy())
+        if len(bad_rows):
+            report[col] = bad_rows
+        df[col] = coerced
+    return df, report
+
+
+def apply_schema(df: pd.DataFrame, schema: Dict[str, str]) -> pd.DataFrame:
+    """
+    Same as coerce_frame, without the report.
+    """
+    return coerce_frame(df, schema)[0]
+
+
+def validate_frame(df: pd.DataFrame, schema: Dict[str, str], name: str):
+    """
+    Check that every schema column of df has the schema dtype.
+    Columns missing from df are not checked, the column projections decide
+    which columns a sheet must have.
+    """
+    mismatched = {
+        col: f"{df[col].dtype} != {dtype}"
+        for col, dtype in schema.items()
+        if col in df.columns and df[col].dtype != dtype
+    }
+    if mismatched:
+        raise ValueError(f"Invalid column types in '{name}': {mismatched}")
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame, name: str) -> str:
+    """
+    Describe the memory of a frame before and after applying the schema.
+    """
+    before_mb = before.memory_usage(deep=True).sum() / 2**20
+    after_mb = after.memory_usage(deep=True).sum() / 2**20
+    return (
+        f"{name}: {len(after)} rows, {before_mb:.1f} MB -> {after_mb:.1f} MB "
+        f"({before_mb / max(after_mb, 1e-9):.1f}x)"
+    )
+
+
+def compact_frames(
+    frames: Dict[str, pd.DataFrame]
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, CoercionReport]]:
+    """
+    Coerce freshly parsed workbook sheets to WORKBOOK_SCHEMAS and validate them.
+    Return:
+        1. dict of sheet name -> coerced pd.DataFrame
+        2. dict of sheet name -> CoercionReport, sheets without bad cells left
+           out
+    """
+    compacted = {}
+    reports = {}
+    for sheet_name, df in frames.items():
+        schema = WORKBOOK_SCHEMAS[sheet_name]
+        df_compact, report = coerce_frame(df, schema)
+        validate_frame(df_compact, schema, sheet_name)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Schema %s", memory_report(df, df_compact, sheet_name))
+        compacted[sheet_name] = df_compact
+        if report:
+            reports[sheet_name] = report
+    return compacted, reports
+
+
+def describe_coercion_reports(
+    reports: Dict[str, CoercionReport], max_rows: int = 10
+) -> List[str]:
+    """
+    Describe the bad cells of every sheet column, e.g.
+    "sample.collect_time: 2 cells (rows 3, 17)".
+    """
+    lines = []
+    for sheet_name, report in reports.items():
+        for col, rows in report.items():
+            shown = ", ".join(str(row) for row in rows[:max_rows])
+            more = ", ..." if len(rows) > max_rows else ""
+            lines.append(f"{sheet_name}.{col}: {len(rows)} cells (rows {shown}{more})")
+    return lines
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate frames of the same schema. Categorical columns are unioned
+    into one sorted dictionary so they stay categorical even when the frames
+    have different categories. Columns missing from some frames (e.g.
+    source_file) are filled with missing values there.
+    """
+    columns = {}
+    for col in dict.fromkeys(col for df in frames for col in df.columns):
+        dtypes = [df[col].dtype for df in frames if col in df.columns]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            parts = [
+                (
+                    df[col]
+                    if col in df.columns
+                    else pd.Categorical([None] * len(df), categories=[])
+                )
+                for df in frames
+            ]
+            columns[col] = union_categoricals(
+                parts, sort_categories=True, ignore_order=True
+            )
+        else:
+            parts = [
+                (
+                    df[col]
+                    if col in df.columns
+                    else pd.Series([None] * len(df), dtype=dtypes[0])
+                )
+                for df in frames
+            ]
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
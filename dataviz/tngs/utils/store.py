@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from utils.constants import DATASET_STORE_DIR
+
+logger = logging.getLogger(__name__)
+
+
+def _dataset_dir(dataset_key: str) -> str:
+    return os.path.join(DATASET_STORE_DIR, dataset_key)
+
+
+def _sheet_path(dataset_key: str, sheet_name: str) -> str:
+    return os.path.join(_dataset_dir(dataset_key), f"{sheet_name}.parquet")
+
+
+def has_dataset(dataset_key: str, sheet_names: Iterable[str]) -> bool:
+    """
+    Check if the Parquet sidecar of every sheet exists for a dataset.
+    """
+    return all(
+        os.path.isfile(_sheet_path(dataset_key, sheet_name))
+        for sheet_name in sheet_names
+    )
+
+
+def _reports_path(dataset_key: str) -> str:
+    return os.path.join(_dataset_dir(dataset_key), "coercion_reports.json")
+
+
+def _aggregates_path(dataset_key: str) -> str:
+    return os.path.join(_dataset_dir(dataset_key), "aggregates.json")
+
+
+def write_dataset(
+    dataset_key: str,
+    frames: Dict[str, pd.DataFrame],
+    coercion_reports: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+    aggregates: Optional[Dict] = None,
+) -> bool:
+    """
+    Write one Parquet file per sheet into the store directory of a dataset,
+    the coercion reports of the sheets if any, and the dataset aggregates
+    (JSON-serialisable) if given.
+    The sheets are written into a temporary directory first and moved into
+    place together, so readers never see a partially written dataset.
+    Return:
+        1. bool, False if the frames could not be written (e.g. mixed types in
+           an object column), the store is only an accelerator
+    """
+    dataset_dir = _dataset_dir(dataset_key)
+    tmp_dir = f"{dataset_dir}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(tmp_dir)
+        for sheet_name, df in frames.items():
+            df.to_parquet(
+                os.path.join(tmp_dir, f"{sheet_name}.parquet"),
+                engine="pyarrow",
+                index=False,
+            )
+        if coercion_reports:
+            with open(os.path.join(tmp_dir, "coercion_reports.json"), "w") as f:
+                json.dump(
+                    {
+                        sheet_name: {col: rows.tolist() for col, rows in report.items()}
+                        for sheet_name, report in coercion_reports.items()
+                    },
+                    f,
+                )
+        if aggregates is not None:
+            with open(os.path.join(tmp_dir, "aggregates.json"), "w") as f:
+                json.dump(aggregates, f)
+        os.replace(tmp_dir, dataset_dir)
+    except OSError as e:
+        # Another session stored the same dataset first
+        if os.path.isdir(dataset_dir):
+            return True
+        logger.warning("Cannot write dataset store '%s': %s", dataset_dir, e)
+        return False
+    except Exception as e:
+        logger.warning("Cannot write dataset store '%s': %s", dataset_dir, e)
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return True
+
+
+def read_sheet(dataset_key: str, sheet_name: str) -> pd.DataFrame:
+    """
+    Read a sheet of a stored dataset.
+    Input:
+        1. dataset_key: key the dataset was written with
+        2. sheet_name: e.g. "etiology"
+    Return:
+        1. pd.DataFrame, read from a memory-mapped Parquet file
+    """
+    # "string" columns come back Arrow-backed, as they were written
+    with pd.option_context("mode.string_storage", "pyarrow"):
+        return pd.read_parquet(
+            _sheet_path(dataset_key, sheet_name),
+            engine="pyarrow",
+            memory_map=True,
+        )
+
+
+def read_coercion_reports(dataset_key: str) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Read the coercion reports stored with a dataset, empty if there are none.
+    """
+    try:
+        with open(_reports_path(dataset_key)) as f:
+            reports = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {
+        sheet_name: {
+            col: np.asarray(rows, dtype=np.int64) for col, rows in report.items()
+        }
+        for sheet_name, report in reports.items()
+    }
+
+
+def read_aggregates(dataset_key: str) -> Optional[Dict]:
+    """
+    Read the aggregates stored with a dataset, None if there are none (e.g.
+    datasets stored before they were).
+    """
+    try:
+        with open(_aggregates_path(dataset_key)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,84 @@
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from utils.constants import TEXT_MAX_WORD_CHARS
+from wordcloud import STOPWORDS
+
+# Same words as WordCloud's default tokenizer: 2+ word characters
+_WORD = re.compile(r"\w[\w']+")
+_CJK = re.compile(r"^[一-鿿]+$")
+_STOPWORDS = {word.lower() for word in STOPWORDS}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split clinical text into words.
+    Words are separated by spaces and punctuation, as WordCloud does. Chinese
+    text is often not segmented, so CJK runs longer than TEXT_MAX_WORD_CHARS
+    are split into overlapping character bigrams instead of being kept as one
+    sentence-long word. Latin words are lower-cased, digits and English stop
+    words are dropped.
+    """
+    tokens = []
+    for word in _WORD.findall(text):
+        if word.endswith("'s"):
+            word = word[:-2]
+        if word.isdigit() or word.lower() in _STOPWORDS:
+            continue
+        if _CJK.match(word):
+            if len(word) > TEXT_MAX_WORD_CHARS:
+                tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+            else:
+                tokens.append(word)
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+class TokenIndex(NamedTuple):
+    # Vocabulary of the column
+    tokens: pd.Index
+    # Rows x tokens counts, in the row order of the tokenized column
+    counts: sparse.csr_matrix
+
+
+def build_token_index(values: pd.Series) -> TokenIndex:
+    """
+    Tokenize every row of a text column once into a sparse count matrix.
+    """
+    row_ids = []
+    words = []
+    for row, text in enumerate(values.to_numpy(dtype=object)):
+        if isinstance(text, str):
+            tokens = tokenize(text)
+            row_ids.extend([row] * len(tokens))
+            words.extend(tokens)
+    codes, tokens = pd.factorize(pd.Series(words, dtype=object))
+    counts = sparse.csr_matrix(
+        (np.ones(len(codes), dtype=np.int32), (np.asarray(row_ids), codes)),
+        shape=(len(values), len(tokens)),
+    )
+    counts.sum_duplicates()
+    return TokenIndex(pd.Index(tokens), counts)
+
+
+def token_frequencies(
+    index: TokenIndex, rows: Optional[np.ndarray] = None, max_words: int = 200
+) -> Dict[str, int]:
+    """
+    Count the tokens of some rows of a TokenIndex.
+    Input:
+        1. index: TokenIndex of a column
+        2. rows: row positions to count, None for all rows
+        3. max_words: keep the most frequent tokens only
+    Return:
+        1. dict of token -> count, for WordCloud.generate_from_frequencies
+    """
+    counts = index.counts if rows is None else index.counts[rows]
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+    top = np.argsort(-totals, kind="stable")[:max_words]
+    top = top[totals[top] > 0]
+    return dict(zip(index.tokens[top], totals[top].tolist()))